@@ -1 +1,8 @@
 from .avl import *
+from .pool import PooledAVLTree, PoolNode
+from .frozen import FrozenAVLTree
+from .sharded import ShardedAVLTree
+from .threadsafe import ConcurrentAVLTree
+from .persistent import PersistentAVLTree, PersistentNode
+from .instrumented import InstrumentedAVLTree
+from .multiset import AVLMultiset, AVLMultisetNode
@@ -0,0 +1,133 @@
+'''
+Asyncio-friendly traversal and bulk updates for AVLTree.
+
+Each operation works through a batch of keys at a time and hands control
+back to the event loop between batches, so a large tree never stalls the
+other tasks on the loop. Nothing is awaited partway through a batch, so
+whenever another task runs the tree is complete and balanced. Iterators
+look their place up again by key after every batch, so other tasks may
+change the tree while they are suspended.
+'''
+import asyncio
+import heapq
+from itertools import islice
+
+from .avl import AVLTree, build_balanced, chain_nodes, join_nodes, merge_union
+
+# Keys handled between returns to the event loop, unless an operation is
+# given its own budget. For small keys that is about 1-3ms of reading or
+# building per batch, and about 10ms of inserting into a large tree.
+YIELD_EVERY = 1024
+
+
+def resumable_irange(tree, lo=None, hi=None, inclusive=(True, False),
+                     reverse=False, budget=None):
+    '''
+    Like tree.irange, but reads budget keys at a time and searches for
+    the last key read before reading the next batch. The tree may change
+    between batches: keys present throughout are each yielded once, in
+    order, and keys added or removed meanwhile may or may not be seen.
+    '''
+    budget = budget or YIELD_EVERY
+    lo_inclusive, hi_inclusive = inclusive
+    while True:
+        chunk = list(islice(tree.irange(lo, hi, (lo_inclusive, hi_inclusive),
+                                        reverse), budget))
+        yield from chunk
+        if len(chunk) < budget:
+            return
+        if reverse:
+            hi, hi_inclusive = chunk[-1], False
+        else:
+            lo, lo_inclusive = chunk[-1], False
+
+
+async def airange(tree, lo=None, hi=None, inclusive=(True, False),
+                  reverse=False, budget=None):
+    budget = budget or YIELD_EVERY
+    keys = resumable_irange(tree, lo, hi, inclusive, reverse, budget)
+    while True:
+        chunk = list(islice(keys, budget))
+        for key in chunk:
+            yield key
+        if len(chunk) < budget:
+            return
+        await asyncio.sleep(0)
+
+
+async def ainsert_many(tree, keys, ignore_duplicates=False, budget=None):
+    '''
+    Insert keys with tree.insert_many, budget keys at a time. Each batch
+    is applied whole, but a duplicate raises ValueError with the earlier
+    batches already inserted.
+    '''
+    budget = budget or YIELD_EVERY
+    keys = iter(keys)
+    while True:
+        chunk = list(islice(keys, budget))
+        if not chunk:
+            return
+        tree.insert_many(chunk, ignore_duplicates)
+        await asyncio.sleep(0)
+
+
+async def aextend(tree, keys, budget=None):
+    '''
+    Add strictly increasing keys, all greater than the tree's largest key.
+    Each batch is built into a balanced subtree and joined on the right in
+    O(log n), so the total cost stays linear.
+    '''
+    budget = budget or YIELD_EVERY
+    keys = iter(keys)
+    while True:
+        chunk = list(islice(keys, budget))
+        if not chunk:
+            return
+        if tree.root is not None and not chunk[0] > tree.max():
+            raise ValueError("Can't add node for key: {}".format(chunk[0]))
+
+        head, count = chain_nodes(tree.node_class(k) for k in chunk)
+        if tree.index is not None:
+            node = head
+            while node is not None:
+                tree.index[node.key] = node
+                node = node.right
+        right = build_balanced(head.right, count - 1)
+        tree.root = join_nodes(tree.root, head, right)
+        await asyncio.sleep(0)
+
+
+async def asorted(keys, budget=None, executor=None):
+    '''
+    Return an iterator over keys in sorted order. With an executor the
+    sort runs there; a process pool keeps it off the event loop entirely.
+    Otherwise runs of budget keys are sorted between yields and merged
+    lazily as the caller consumes them.
+    '''
+    keys = list(keys)
+    if executor is not None:
+        loop = asyncio.get_running_loop()
+        return iter(await loop.run_in_executor(executor, sorted, keys))
+
+    budget = budget or YIELD_EVERY
+    runs = []
+    for start in range(0, len(keys), budget):
+        runs.append(sorted(keys[start:start + budget]))
+        await asyncio.sleep(0)
+    return heapq.merge(*runs)
+
+
+async def afrom_keys(cls, keys, hash_index=False, budget=None, executor=None):
+    tree = cls(hash_index=hash_index)
+    await aextend(tree, await asorted(keys, budget, executor), budget)
+    return tree
+
+
+async def aunion(a, b, budget=None):
+    if a.keyfunc is not None:
+        raise TypeError('aunion needs a tree without a key function')
+    tree = AVLTree(hash_index=a.index is not None)
+    await aextend(tree, merge_union(resumable_irange(a, budget=budget),
+                                    resumable_irange(b, budget=budget)),
+                  budget)
+    return tree
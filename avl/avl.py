@@ -1,6 +1,28 @@
+import io
 import sys
+from bisect import bisect_left, bisect_right
+from collections.abc import (ItemsView, KeysView, Mapping, MutableMapping,
+                             ValuesView)
+from itertools import islice
+from math import log2
+from operator import attrgetter, itemgetter
+
+from .snapshot import read_snapshot, write_snapshot
 assert sys.version[0] == '3'
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Default for lookups that raise KeyError when nothing is found
+MISSING = object()
+
+# Relative per-key costs used to choose between finger descents and a
+# linear rebuild for batch updates, in units of one descent step
+FINGER_OVERHEAD = 6
+REBUILD_COST = 2
+
 
 class Stack(object):
 
@@ -56,10 +78,12 @@ class StackItem(object):
 class AVLNode(object):
 
     'A node in a self-balancing tree'
+    __slots__ = ['key', 'height', 'size', 'left', 'right', 'parent']
 
     def __init__(self, key):
         self.key = key
-        self.height = 0
+        self.height = 1
+        self.size = 1
         self.left = None
         self.right = None
         self.parent = None
@@ -91,9 +115,11 @@ class AVLNode(object):
         return verfied and parcheck
 
     def update_height(self):
-        lheight = self.left.height if self.left is not None else 0
-        rheight = self.right.height if self.right is not None else 0
+        left, right = self.left, self.right
+        lheight, lsize = (left.height, left.size) if left is not None else (0, 0)
+        rheight, rsize = (right.height, right.size) if right is not None else (0, 0)
         self.height = max(lheight, rheight) + 1
+        self.size = lsize + rsize + 1
 
     @property
     def children(self):
@@ -113,88 +139,437 @@ class AVLNode(object):
         return -1 <= self.balance <= 1
 
 
-class AVLTree(object):
+class AVLMapNode(AVLNode):
+
+    'A tree node that also carries a value'
+    __slots__ = ['value']
 
-    def __init__(self):
+    def __init__(self, key, value=None):
+        super().__init__(key)
+        self.value = value
+
+
+class AVLTree(object):
+    node_class = AVLNode
+    index = None
+    finger_search = False
+    finger = None
+
+    def __init__(self, key=None, hash_index=False, finger=False):
+        '''
+        With a key function, as in sorted(key=...), the tree holds elements
+        ordered by key(element). The extracted key is computed once and
+        kept as node.key, with the element as node.value. insert, delete,
+        the batch methods and `in` then take elements, while find_node,
+        contains_key and the ordered queries take extracted keys.
+
+        With hash_index, the tree also keeps a dict from each (hashable)
+        key to its node, making `in`, find_node and the start of delete,
+        predecessor and successor O(1). Operations that relink the tree
+        wholesale, including split, join and range deletion, then rebuild
+        the index in O(n).
+
+        With finger, insert, find_node and `in` start from the node last
+        touched, climbing only as far as needed to span the key. Lookups
+        that land near the previous one then cost O(log d) for a distance
+        of d keys, but scattered lookups pay for the climb on top of the
+        descent, so it is worth enabling only for local access patterns.
+        '''
         self.root = None
+        self.keyfunc = key
+        if key is not None:
+            self.node_class = AVLMapNode
+        if hash_index:
+            self.index = {}
+        if finger:
+            self.finger_search = True
+
+    @classmethod
+    def from_keys(cls, keys, key=None, hash_index=False, workers=None,
+                  finger=False):
+        '''
+        Build a balanced tree from unsorted keys. Without a key function,
+        a large batch can be sorted in ranges by a pool of worker
+        processes (see avl.parallel).
+        '''
+        if key is not None:
+            pairs = [(key(x), x) for x in keys]
+            if not all(a[0] < b[0]
+                       for a, b in zip(pairs, islice(pairs, 1, None))):
+                pairs.sort(key=itemgetter(0))
+            tree = cls(key=key, hash_index=hash_index)
+            tree.root = build_balanced(*chain_nodes(AVLMapNode(k, x)
+                                                    for k, x in pairs))
+            tree.reindex()
+            if finger:
+                tree.finger_search = True
+            return tree
+
+        keys = list(keys)
+        if not all(a < b for a, b in zip(keys, islice(keys, 1, None))):
+            if workers:
+                from .parallel import sort_keys
+                keys = sort_keys(keys, workers)
+            else:
+                keys.sort()
+        return cls.from_sorted(keys, hash_index=hash_index, finger=finger)
+
+    @classmethod
+    async def afrom_keys(cls, keys, hash_index=False, budget=None,
+                         executor=None):
+        '''
+        Build a tree from unsorted keys without stalling the event loop
+        (see avl.aio). The sort can be handed to an executor.
+        '''
+        from .aio import afrom_keys
+        return await afrom_keys(cls, keys, hash_index, budget, executor)
+
+    @classmethod
+    def from_sorted(cls, keys, key=None, hash_index=False, finger=False):
+        'Build a balanced tree in linear time from strictly increasing keys'
+        if key is not None:
+            tree = cls(key=key, hash_index=hash_index)
+            nodes = (AVLMapNode(key(x), x) for x in keys)
+        else:
+            tree = cls(hash_index=hash_index)
+            nodes = (cls.node_class(k) for k in keys)
 
-    @staticmethod
-    def from_keys(keys):
-        tree = AVLTree()
-        for key in keys:
-            tree.insert(key)
+        tree.root = build_balanced(*chain_nodes(nodes))
+        tree.reindex()
+        if finger:
+            tree.finger_search = True
+        return tree
 
+    @classmethod
+    def from_array(cls, array, hash_index=False):
+        '''
+        Build a tree from an unsorted sequence that may repeat keys, such
+        as a NumPy array, which is then sorted and deduplicated by NumPy
+        '''
+        if np is not None:
+            return cls.from_sorted(np.unique(array).tolist(),
+                                   hash_index=hash_index)
+        return cls.from_sorted(sorted(set(array)), hash_index=hash_index)
+
+    def reindex(self):
+        '''
+        Rebuild the hash index, if enabled, and drop the finger after
+        relinking the tree
+        '''
+        if self.index is not None:
+            self.index = {node.key: node for node in self.traverse()}
+        if self.finger_search:
+            self.finger = None
+
+    def dump(self, fileobj):
+        '''
+        Write the tree's elements to a binary file object as a compact
+        snapshot of sorted keys. The key function is not saved.
+        '''
+        write_snapshot(fileobj, self.elements())
+
+    @classmethod
+    def load(cls, fileobj, key=None, hash_index=False):
+        'Rebuild a tree in linear time from a snapshot written by dump'
+        tree = (cls(key=key, hash_index=hash_index) if key is not None else
+                cls(hash_index=hash_index))
+        tree.read_snapshot(fileobj)
         return tree
 
+    def read_snapshot(self, fileobj):
+        if self.keyfunc is None:
+            nodes = (self.node_class(k) for k in read_snapshot(fileobj))
+        else:
+            nodes = (AVLMapNode(self.keyfunc(x), x)
+                     for x in read_snapshot(fileobj))
+        self.root = build_balanced(*chain_nodes(nodes))
+        self.reindex()
+
+    def freeze(self, path=None):
+        '''
+        Return a read-only FrozenAVLTree of the keys, held in memory or,
+        given a path, written there and memory mapped
+        '''
+        from .frozen import FrozenAVLTree
+        return FrozenAVLTree.from_sorted(self.keys(), path)
+
+    def __getstate__(self):
+        # Pickle as a flat snapshot rather than the linked node graph
+        state = self.__dict__.copy()
+        del state['root']
+        state.pop('finger', None)
+        if self.index is not None:
+            state['index'] = {}
+        buf = io.BytesIO()
+        self.dump(buf)
+        state['snapshot'] = buf.getvalue()
+        return state
+
+    def __setstate__(self, state):
+        state = state.copy()
+        snapshot = state.pop('snapshot')
+        self.__dict__.update(state)
+        self.read_snapshot(io.BytesIO(snapshot))
+
     def __contains__(self, key):
+        if self.keyfunc is not None:
+            key = self.keyfunc(key)
+        if self.index is not None:
+            return key in self.index
+        if self.finger_search:
+            return self._finger_locate(key)[1]
+
         node = self.root
-        while node:
+        while node is not None:
             if key > node.key:
                 node = node.right
             elif key < node.key:
                 node = node.left
-            elif key == node.key:
+            else:
                 return True
-
         return False
 
     def __nonzero__(self):
         return self.root is None
 
     def __len__(self):
-        return self.size()
+        return self.root.size if self.root is not None else 0
+
+    def __iter__(self):
+        return self.elements()
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            raise TypeError('Trees are indexed by position only; use irange '
+                            'for a range of keys')
+        return self.select(index)
 
     def traverse(self, reverse=False):
-        if not self.root:
+        '''
+        Yield the nodes in order, following parent pointers rather than
+        keeping a stack
+        '''
+        if self.root is None:
+            return
+
+        step = prev_node if reverse else next_node
+        node = self.max_node() if reverse else self.min_node()
+        while node is not None:
+            yield node
+            node = step(node)
+
+    def size(self):
+        return len(self)
+
+    def keys(self):
+        node = self.root
+        if node is None:
             return
+        while node.left is not None:
+            node = node.left
 
+        while node is not None:
+            yield node.key
+            if node.right is not None:
+                node = node.right
+                while node.left is not None:
+                    node = node.left
+            else:
+                while node.parent is not None and node is node.parent.right:
+                    node = node.parent
+                node = node.parent
+
+    def cursor(self, key=None):
+        '''
+        Return a Cursor on the smallest key greater than or equal to key,
+        or on the minimum
+        '''
+        cursor = Cursor(self)
+        if key is None:
+            cursor.node = self.min_node() if self.root is not None else None
+        else:
+            cursor.seek(key)
+        return cursor
+
+    def elements(self):
+        '''
+        Yield the stored elements in order. These are the keys themselves
+        unless the tree has a key function.
+        '''
+        if self.keyfunc is None:
+            yield from self.keys()
+        else:
+            yield from (node.value for node in self.traverse())
+
+    def contains_key(self, key):
+        'Test for an extracted key, bypassing the key function'
+        return self.locate(key)[1]
+
+    def irange(self, lo=None, hi=None, inclusive=(True, False), reverse=False):
+        '''
+        Yield the keys between lo and hi in order, without visiting the rest
+        of the tree. A bound of None leaves that side open, and inclusive
+        says whether each bound is itself included.
+        '''
+        yield from (node.key for node in
+                    self.irange_nodes(lo, hi, inclusive, reverse))
+
+    def aiter_keys(self, budget=None):
+        '''
+        Iterate the keys with async for, returning to the event loop every
+        budget keys. The tree may change between batches (see avl.aio).
+        '''
+        return self.airange(budget=budget)
+
+    def airange(self, lo=None, hi=None, inclusive=(True, False),
+                reverse=False, budget=None):
+        from .aio import airange
+        return airange(self, lo, hi, inclusive, reverse, budget)
+
+    def irange_nodes(self, lo=None, hi=None, inclusive=(True, False),
+                     reverse=False):
+        lo_inclusive, hi_inclusive = inclusive
+        if self.root is None:
+            return
+
+        # Find the first node in range, then step along parent pointers
+        # until the far bound
         if reverse:
-            yield from self._traverse_reverse()
+            first, first_inclusive, step = hi, hi_inclusive, prev_node
+            last, last_inclusive = lo, lo_inclusive
         else:
-            yield from self._traverse()
+            first, first_inclusive, step = lo, lo_inclusive, next_node
+            last, last_inclusive = hi, hi_inclusive
 
-    def _traverse(self):
-        s = Stack()
-        node = self.root
-        while (not s.empty()) or (node is not None):
+        def past_last(key):
+            if key == last:
+                return not last_inclusive
+            return key < last if reverse else key > last
+
+        if first is None:
+            node = self.max_node() if reverse else self.min_node()
+        else:
+            try:
+                node = self.bound_node(first, reverse, first_inclusive)
+            except KeyError:
+                return
+
+        while node is not None:
+            if last is not None and past_last(node.key):
+                return
+            yield node
+            node = step(node)
+
+    def bound_node(self, key, below, inclusive):
+        '''
+        Return the node with the closest key below (or above) key. The
+        node holding key itself qualifies only when inclusive is True.
+        '''
+        if self.index is not None and key in self.index:
+            # Step from the key's own node instead of descending
+            node = self.index[key]
+            if not inclusive:
+                node = prev_node(node) if below else next_node(node)
             if node is not None:
-                s.push(node)
-                node = node.left
-            else:
-                node = s.pop()
-                yield node 
-                node = node.right
+                return node
+            raise KeyError('No key {} {}'.format('below' if below else 'above',
+                                                 key))
 
-    def _traverse_reverse(self):
-        s = Stack()
+        best = None
         node = self.root
-        while (not s.empty()) or (node is not None):
-            if node is not None:
-                s.push(node)
+        while node is not None:
+            if key > node.key:
+                if below:
+                    best = node
                 node = node.right
-            else:
-                node = s.pop()
-                yield node 
+            elif key < node.key:
+                if not below:
+                    best = node
                 node = node.left
+            elif inclusive:
+                return node
+            else:
+                node = node.left if below else node.right
 
-    def size(self):
-        return sum(1 for node in self.traverse())
+        if best is None:
+            raise KeyError('No key {} {}'.format('below' if below else 'above',
+                                                 key))
+        return best
 
-    def keys(self):
-        yield from (node.key for node in self.traverse())
+    def floor(self, key):
+        'Return the largest key less than or equal to key'
+        return self.bound_node(key, below=True, inclusive=True).key
+
+    def ceiling(self, key):
+        'Return the smallest key greater than or equal to key'
+        return self.bound_node(key, below=False, inclusive=True).key
+
+    def predecessor(self, key):
+        'Return the largest key strictly less than key'
+        return self.bound_node(key, below=True, inclusive=False).key
+
+    def successor(self, key):
+        'Return the smallest key strictly greater than key'
+        return self.bound_node(key, below=False, inclusive=False).key
 
     def find_node(self, key):
+        if self.index is not None:
+            try:
+                return self.index[key]
+            except KeyError:
+                raise KeyError('Key not found: {}'.format(key)) from None
+        if self.finger_search:
+            node, found = self._finger_locate(key)
+            if not found:
+                raise KeyError('Key not found: {}'.format(key))
+            return node
+
         node = self.root
         while node is not None:
-
-            if node.key == key:
+            if key > node.key:
+                node = node.right
+            elif key < node.key:
+                node = node.left
+            else:
                 return node
+        raise KeyError('Key not found: {}'.format(key))
 
+    def rank(self, key):
+        'Return the number of keys in the tree less than key'
+        rank = 0
+        node = self.root
+        while node is not None:
+            if key > node.key:
+                rank += node.left.size + 1 if node.left is not None else 1
+                node = node.right
             elif key < node.key:
                 node = node.left
-            elif key > node.key:
+            else:
+                rank += node.left.size if node.left is not None else 0
+                break
+        return rank
+
+    def select_node(self, index):
+        'Return the node holding the index-th smallest key'
+        n = len(self)
+        if index < 0:
+            index += n
+        if not 0 <= index < n:
+            raise IndexError('Tree index out of range: {}'.format(index))
+
+        node = self.root
+        while True:
+            lsize = node.left.size if node.left is not None else 0
+            if index < lsize:
+                node = node.left
+            elif index > lsize:
+                index -= lsize + 1
                 node = node.right
-        raise KeyError('Key not found: {}'.format(key))
+            else:
+                return node
+
+    def select(self, index):
+        return self.select_node(index).key
 
     def path_to_root(self, key):
         s = Stack()
@@ -214,244 +589,1358 @@ class AVLTree(object):
         s.reverse()
         return s
 
+    def locate(self, key, start=None):
+        '''
+        Descend towards key. Returns (node, True) if key is in the tree,
+        otherwise (parent, False) where parent is the node a new node for
+        key would hang from. The descent begins at start, which must span
+        key (see climb), or at the root.
+        '''
+        if self.index is not None and key in self.index:
+            return self.index[key], True
+
+        parent = None
+        node = start if start is not None else self.root
+        while node is not None:
+            if key > node.key:
+                parent, node = node, node.right
+            elif key < node.key:
+                parent, node = node, node.left
+            else:
+                return node, True
+        return parent, False
+
+    def _finger_locate(self, key):
+        # locate, starting from climb(finger, key) and leaving the finger
+        # on the node reached. Both loops are inlined, as the calls would
+        # cost as much as the levels saved on a short climb.
+        node = self.finger
+        if node is None:
+            node = self.root
+        elif key > node.key:
+            lowest = node
+            while node.parent is not None:
+                parent = node.parent
+                if node is parent.left:
+                    if key < parent.key:
+                        break
+                    lowest = parent
+                node = parent
+            node = lowest
+        elif key < node.key:
+            lowest = node
+            while node.parent is not None:
+                parent = node.parent
+                if node is parent.right:
+                    if key > parent.key:
+                        break
+                    lowest = parent
+                node = parent
+            node = lowest
+        else:
+            return node, True
+
+        parent = None
+        while node is not None:
+            if key > node.key:
+                parent, node = node, node.right
+            elif key < node.key:
+                parent, node = node, node.left
+            else:
+                self.finger = node
+                return node, True
+        if parent is not None:
+            self.finger = parent
+        return parent, False
+
+    def climb(self, node, key):
+        '''
+        Climb from node to its lowest ancestor (or node itself) whose
+        subtree spans key. Costs O(log d) for a key d positions away.
+        '''
+        # A run of ancestors linked through right (left) children shares
+        # the same upper (lower) bound, so the answer is the bottom of the
+        # first run whose bound lies beyond key. Past the maximum (minimum)
+        # that is node itself rather than the root.
+        lowest = node
+        if key > node.key:
+            while node.parent is not None:
+                parent = node.parent
+                if node is parent.left:
+                    if key < parent.key:
+                        break
+                    lowest = parent
+                node = parent
+        elif key < node.key:
+            while node.parent is not None:
+                parent = node.parent
+                if node is parent.right:
+                    if key > parent.key:
+                        break
+                    lowest = parent
+                node = parent
+        return lowest
+
+    def attach(self, parent, node):
+        'Hang a new node below parent (or at the root) and rebalance'
+        if parent is None:
+            self.root = node
+        else:
+            if node.key > parent.key:
+                parent.right = node
+            else:
+                parent.left = node
+            node.parent = parent
+            self.retrace(parent, 1)
+
+        if self.index is not None:
+            self.index[node.key] = node
+
     def insert(self, key):
-        new_node = AVLNode(key)
+        if self.keyfunc is None:
+            new_node = self.node_class(key)
+        else:
+            new_node = AVLMapNode(self.keyfunc(key), key)
 
-        if self.root is None:
-            self.root = new_node
+        if self.finger_search:
+            parent, found = self._finger_locate(new_node.key)
+        else:
+            parent, found = self.locate(new_node.key)
+        if found:
+            raise ValueError("Can't add node for key: {}".format(new_node.key))
+        self.attach(parent, new_node)
+        if self.finger_search:
+            self.finger = new_node
+
+    def prefer_rebuild(self, batch_size):
+        '''
+        Whether a sorted batch is cheaper to merge in with a linear rebuild
+        than to apply with finger descents of about log(n / m) steps each
+        '''
+        return not search_is_cheaper(batch_size, len(self))
+
+    def insert_many(self, keys, ignore_duplicates=False):
+        '''
+        Insert a batch of keys. Keys already in the tree (or repeated in
+        the batch) raise ValueError and leave the tree unchanged, unless
+        ignore_duplicates is set.
+        '''
+        if self.keyfunc is None:
+            nodes = [self.node_class(key) for key in sorted(keys)]
+        else:
+            nodes = sorted((AVLMapNode(self.keyfunc(x), x) for x in keys),
+                           key=attrgetter('key'))
+        if not nodes:
             return
 
-        cur_node = self.root
-        while True:
-            if new_node.key > cur_node.key:
-                if cur_node.right is not None:
-                    cur_node = cur_node.right
-                else:
-                    cur_node.right = new_node
-                    new_node.parent = cur_node
-                    break
+        if self.prefer_rebuild(len(nodes)):
+            self._rebuild_insert(nodes, ignore_duplicates)
+        else:
+            self._finger_insert(nodes, ignore_duplicates)
+
+    async def ainsert_many(self, keys, ignore_duplicates=False, budget=None):
+        '''
+        insert_many in batches of budget keys, returning to the event loop
+        between them. Unlike insert_many it is not all-or-nothing: a
+        duplicate raises ValueError after the earlier batches went in.
+        '''
+        from .aio import ainsert_many
+        await ainsert_many(self, keys, ignore_duplicates, budget)
+
+    def _finger_insert(self, nodes, ignore_duplicates):
+        inserted = []
+        finger = None
+        try:
+            for new_node in nodes:
+                key = new_node.key
+                start = self.climb(finger, key) if finger is not None else None
+                parent, found = self.locate(key, start)
+                if found:
+                    if not ignore_duplicates:
+                        raise ValueError("Can't add node for key: {}".format(key))
+                    finger = parent
+                    continue
+
+                finger = new_node
+                self.attach(parent, finger)
+                inserted.append(finger)
+
+        except ValueError:
+            for node in inserted:
+                self.delete_node(node)
+            raise
+
+    def _rebuild_insert(self, new_nodes, ignore_duplicates):
+        nodes = []
+        existing = self.traverse()
+        node = next(existing, None)
+        for new_node in new_nodes:
+            key = new_node.key
+            while node is not None and node.key < key:
+                nodes.append(node)
+                node = next(existing, None)
+
+            if ((node is not None and node.key == key) or
+                    (nodes and nodes[-1].key == key)):
+                if not ignore_duplicates:
+                    raise ValueError("Can't add node for key: {}".format(key))
+                continue
+            nodes.append(new_node)
 
-            elif new_node.key < cur_node.key:
-                if cur_node.left is not None:
-                    cur_node = cur_node.left
-                else:
-                    cur_node.left = new_node
-                    new_node.parent = cur_node
-                    break
+        while node is not None:
+            nodes.append(node)
+            node = next(existing, None)
+
+        self.root = build_balanced(*chain_nodes(nodes))
+        self.reindex()
+
+    def delete_many(self, keys, ignore_missing=False):
+        '''
+        Delete a batch of keys. Keys not in the tree (or repeated in the
+        batch) raise KeyError and leave the tree unchanged, unless
+        ignore_missing is set.
+        '''
+        keys = sorted(keys if self.keyfunc is None else map(self.keyfunc, keys))
+        if not keys:
+            return
+
+        if self.prefer_rebuild(len(keys)):
+            self._rebuild_delete(keys, ignore_missing)
+        else:
+            self._finger_delete(keys, ignore_missing)
+
+    def _finger_delete(self, keys, ignore_missing):
+        # Find every node before changing anything, so a missing key
+        # leaves the tree as it was
+        nodes = []
+        finger = None
+        for key in keys:
+            start = self.climb(finger, key) if finger is not None else None
+            node, found = self.locate(key, start)
+            if not found or (nodes and nodes[-1] is node):
+                if not ignore_missing:
+                    raise KeyError('Key not found: {}'.format(key))
+                continue
+            nodes.append(node)
+            finger = node
+
+        for node in nodes:
+            self.delete_node(node)
+
+    def _rebuild_delete(self, keys, ignore_missing):
+        kept = []
+        keys = iter(keys)
+        key = next(keys, None)
+        for node in self.traverse():
+            while key is not None and key < node.key:
+                if not ignore_missing:
+                    raise KeyError('Key not found: {}'.format(key))
+                key = next(keys, None)
+
+            if key is not None and key == node.key:
+                key = next(keys, None)
+                while key is not None and key == node.key:
+                    if not ignore_missing:
+                        raise KeyError('Key not found: {}'.format(key))
+                    key = next(keys, None)
             else:
-                raise ValueError("Can't add node for key: {}".format(key))
+                kept.append(node)
+
+        if key is not None and not ignore_missing:
+            raise KeyError('Key not found: {}'.format(key))
 
-        parent = new_node
+        self.root = build_balanced(*chain_nodes(kept))
+        self.reindex()
 
-        while parent:
-            self.rebalance_node(parent)
-            parent = parent.parent
+    def retrace(self, node, delta):
+        '''
+        Rebalance from node towards the root after its subtree gained or
+        lost delta keys. Rebalancing stops once a subtree's height is
+        unchanged; past that point only the ancestors' sizes change.
+        '''
+        while node is not None:
+            old_height = node.height
+            subtree = rebalance(node)
+            if node is self.root:
+                self.root = subtree
+            node = subtree.parent
+            if subtree.height == old_height:
+                break
+
+        while node is not None:
+            node.size += delta
+            node = node.parent
 
     def rebalance_node(self, node):
-        node.update_height()
+        '''
+        Update node's height and restore its balance, returning the root of
+        the resulting subtree
+        '''
+        new_root = rebalance(node)
+        if node is self.root:
+            self.root = new_root
+        return new_root
+
+    def _with_root(self, root):
+        # A tree configured like this one, holding the subtree at root
+        tree = self.__class__.__new__(self.__class__)
+        tree.__dict__.update(self.__dict__)
+        tree.root = root
+        if self.index is not None or self.finger_search:
+            tree.reindex()
+        return tree
 
-        if node.is_balanced():
+    def split(self, key):
+        '''
+        Split the tree in O(log n) into a tree of the keys less than key
+        and a tree of the rest. This tree is left empty.
+        '''
+        below, above = split_nodes(self.root, key)
+        self.root = None
+        self.reindex()
+        return self._with_root(below), self._with_root(above)
+
+    @classmethod
+    def join(cls, left, right):
+        '''
+        Join two trees, where every key in left is less than every key in
+        right, in O(log n). Both trees are left empty.
+        '''
+        if left.root is not None and right.root is not None:
+            if not left.max() < right.min():
+                raise ValueError('Trees to join overlap')
+
+        template = left if left.root is not None else right
+        joined = template._with_root(join_pair(left.root, right.root))
+        left.root = right.root = None
+        left.reindex()
+        right.reindex()
+        return joined
+
+    def __delitem__(self, index):
+        '''
+        del tree[i] removes the key at position i, like tree[i]. A slice
+        is a range of keys, not of positions: del tree[lo:hi] removes the
+        keys in [lo, hi) with two splits and a join, as irange(lo, hi)
+        would list them.
+        '''
+        if not isinstance(index, slice):
+            self.delete_node(self.select_node(index))
             return
 
-        if node.balance > 1:
-            if node.right is not None and node.right.balance < 0:
-                new_root = node.right.left
-                rotate_double_left(node)
+        if index.step is not None:
+            raise ValueError('Key range deletion takes no step')
+        lo, hi = index.start, index.stop
+        if lo is not None and hi is not None and not lo < hi:
+            return
 
+        below, above = None, self.root
+        if lo is not None:
+            below, above = split_nodes(above, lo)
+        if hi is not None:
+            _, above = split_nodes(above, hi)
+        else:
+            above = None
+        self.root = join_pair(below, above)
+        self.reindex()
+
+    def replace_child(self, parent, old, new):
+        'Put new in the place old held under parent'
+        if parent is None:
+            self.root = new
+        elif parent.left is old:
+            parent.left = new
+        else:
+            parent.right = new
+        if new is not None:
+            new.parent = parent
+
+    def delete(self, key):
+        if self.root is None:
+            raise KeyError('Tree is empty')
+
+        if self.keyfunc is not None:
+            key = self.keyfunc(key)
+        self.delete_node(self.find_node(key))
+
+    def delete_node(self, node):
+        parent = node.parent
+
+        if node.left is None or node.right is None:
+            child = node.left if node.left is not None else node.right
+            self.replace_child(parent, node, child)
+            start = parent
+
+        else:
+            # Splice out the in-order predecessor, which has no right
+            # child, and move it into the deleted node's place
+            replacement = node.left
+            while replacement.right is not None:
+                replacement = replacement.right
+
+            if replacement is node.left:
+                start = replacement
             else:
-                new_root = node.right
-                rotate_left(node)
+                start = replacement.parent
+                self.replace_child(start, replacement, replacement.left)
+                replacement.left = node.left
+                replacement.left.parent = replacement
+
+            replacement.right = node.right
+            replacement.right.parent = replacement
+            replacement.height, replacement.size = node.height, node.size
+            self.replace_child(parent, node, replacement)
+
+        node.left = node.right = node.parent = None
+        if self.index is not None:
+            del self.index[node.key]
+        if self.finger_search:
+            # Rotations keep nodes in the tree, so start stays valid
+            self.finger = start
+        self.retrace(start, -1)
+
+    def min_node(self, start=None):
+        if not self.root:
+            raise KeyError('Tree empty!')
+        return leftmost(start or self.root)
+
+    def min(self):
+        return self.min_node().key
 
-        elif node.balance < -1:
-            if node.left is not None and node.left.balance > 0:
-                new_root = node.left.right
-                rotate_double_right(node)
+    def max_node(self, start=None):
+        if not self.root:
+            raise KeyError('Tree empty!')
+        return rightmost(start or self.root)
 
+    def max(self):
+        return self.max_node().key
+
+    # Bulk queries. These take any sequence of keys. A few keys are each
+    # answered by a descent; many are searched for in a flattened copy of
+    # the tree's keys, with bisect, or for a numeric NumPy array with
+    # searchsorted, in which case an array is returned.
+
+    def contains_many(self, keys):
+        'Return a mask of which keys are in the tree'
+        column = self._key_column(keys)
+        if column is None:
+            return self._bulk(keys, [below is not None and below is above
+                                     for _, below, above in
+                                     map(self.probe, keys)])
+        elif isinstance(column, list):
+            n = len(column)
+            return self._bulk(keys, [i < n and column[i] == key
+                                     for key, i in zip(keys, (
+                                         bisect_left(column, key)
+                                         for key in keys))])
+        return (np.searchsorted(column, keys, 'right') >
+                np.searchsorted(column, keys, 'left'))
+
+    def rank_many(self, keys):
+        'Return the number of keys in the tree less than each key'
+        column = self._key_column(keys)
+        if column is None:
+            return self._bulk(keys, [self.rank(key) for key in keys])
+        elif isinstance(column, list):
+            return self._bulk(keys, [bisect_left(column, key)
+                                     for key in keys])
+        return np.searchsorted(column, keys, 'left')
+
+    def floor_many(self, keys, default=MISSING):
+        '''
+        Return the floor of each key. Keys with no floor take default, or
+        raise KeyError if no default is given.
+        '''
+        column = self._key_column(keys)
+        if column is None:
+            return self._bulk(keys, [_bound_key(below, key, default)
+                                     for key, (_, below, _) in
+                                     zip(keys, map(self.probe, keys))])
+        elif isinstance(column, list):
+            return self._bulk(keys, _take(column, [bisect_right(column, key) - 1
+                                                   for key in keys],
+                                          keys, default))
+        return _take(column, np.searchsorted(column, keys, 'right') - 1,
+                     keys, default)
+
+    def ceiling_many(self, keys, default=MISSING):
+        '''
+        Return the ceiling of each key. Keys with no ceiling take default,
+        or raise KeyError if no default is given.
+        '''
+        column = self._key_column(keys)
+        if column is None:
+            return self._bulk(keys, [_bound_key(above, key, default)
+                                     for key, (_, _, above) in
+                                     zip(keys, map(self.probe, keys))])
+        elif isinstance(column, list):
+            return self._bulk(keys, _take(column, [bisect_left(column, key)
+                                                   for key in keys],
+                                          keys, default))
+        return _take(column, np.searchsorted(column, keys, 'left'),
+                     keys, default)
+
+    def _key_column(self, keys):
+        # The tree's keys flattened for searching, or None when the tree
+        # is empty or there are too few queries to make flattening it
+        # worthwhile
+        if self.root is None or search_is_cheaper(len(keys), len(self)):
+            return None
+        column = list(self.keys())
+        if (np is not None and isinstance(keys, np.ndarray) and
+                keys.dtype.kind in 'iuf'):
+            array = np.array(column)
+            if array.dtype.kind in 'iuf':
+                return array
+        return column
+
+    def _bulk(self, keys, results):
+        if np is not None and isinstance(keys, np.ndarray):
+            return np.array(results)
+        return results
+
+    def probe(self, key):
+        '''
+        Descend once towards key, returning its rank and the nodes holding
+        its floor and ceiling, which are None past the ends
+        '''
+        rank = 0
+        below = above = None
+        node = self.root
+        while node is not None:
+            if key > node.key:
+                rank += node.left.size + 1 if node.left is not None else 1
+                below, node = node, node.right
+            elif key < node.key:
+                above, node = node, node.left
             else:
-                new_root = node.left
-                rotate_right(node)
+                rank += node.left.size if node.left is not None else 0
+                return rank, node, node
+        return rank, below, above
 
+    # Set algebra. Operands may be any tree with keys() and len(), such as
+    # a FrozenAVLTree. When one side is much smaller, its keys are looked
+    # up in the other with finger descents in O(m log(n/m)) instead of
+    # walking both trees.
+
+    def intersection(self, other):
+        if self.keyfunc is None and not search_is_cheaper(
+                min(len(self), len(other)), max(len(self), len(other))):
+            keys = merge_intersection(self.keys(), other.keys())
+            return AVLTree.from_sorted(keys, hash_index=self.index is not None)
+        return self._copy_nodes(self._common_nodes(other))
+
+    def union(self, other):
+        self._check_elements(other)
+        if self.keyfunc is not None:
+            return self._copy_pairs(merge_sorted(key_element_pairs(self),
+                                                 key_element_pairs(other),
+                                                 True, True, True,
+                                                 key=itemgetter(0)))
+        keys = merge_union(self.keys(), other.keys())
+        return AVLTree.from_sorted(keys, hash_index=self.index is not None)
+
+    async def aunion(self, other, budget=None):
+        'union, built a batch at a time between returns to the event loop'
+        from .aio import aunion
+        return await aunion(self, other, budget)
+
+    def difference(self, other):
+        return self._copy_nodes(self._unique_nodes(other))
+
+    def symmetric_difference(self, other):
+        self._check_elements(other)
+        if self.keyfunc is not None:
+            return self._copy_pairs(merge_sorted(key_element_pairs(self),
+                                                 key_element_pairs(other),
+                                                 True, False, True,
+                                                 key=itemgetter(0)))
+        return AVLTree.from_sorted(merge_sorted(self.keys(), other.keys(),
+                                                True, False, True),
+                                   hash_index=self.index is not None)
+
+    def issubset(self, other):
+        return covers(other, self)
+
+    def issuperset(self, other):
+        return covers(self, other)
+
+    def isdisjoint(self, other):
+        small, big = ((self, other) if len(self) <= len(other) else
+                      (other, self))
+        if search_is_cheaper(len(small), len(big)):
+            lookup = sorted_lookup(big)
+            return not any(lookup(key) for key in small.keys())
+
+        common = merge_sorted(self.keys(), other.keys(), False, True, False)
+        return next(common, None) is None
+
+    __or__ = union
+    __and__ = intersection
+    __sub__ = difference
+    __xor__ = symmetric_difference
+
+    def __ior__(self, other):
+        self._check_elements(other)
+        self.insert_many(other.elements(), ignore_duplicates=True)
+        return self
+
+    def __iand__(self, other):
+        self.root = build_balanced(*chain_nodes(list(self._common_nodes(other))))
+        self.reindex()
+        return self
+
+    def __isub__(self, other):
+        if search_is_cheaper(len(other), len(self)):
+            self.delete_many(other.elements(), ignore_missing=True)
         else:
-            pass
-        if node is self.root:
-            self.root = new_root
+            self.root = build_balanced(*chain_nodes(list(
+                self._unique_nodes(other))))
+            self.reindex()
+        return self
+
+    def __ixor__(self, other):
+        self._check_elements(other)
+        pairs = key_element_pairs(other)
+        if search_is_cheaper(len(other), len(self)):
+            lookup = sorted_lookup(self)
+            doomed, added = [], []
+            for key, element in pairs:
+                node = lookup(key)
+                if node is not None:
+                    doomed.append(node)
+                else:
+                    added.append(element)
+
+            for node in doomed:
+                self.delete_node(node)
+            self.insert_many(added)
+            return self
+
+        nodes = []
+        existing = self.traverse()
+        node = next(existing, None)
+        for key, element in pairs:
+            while node is not None and node.key < key:
+                nodes.append(node)
+                node = next(existing, None)
+            if node is not None and node.key == key:
+                node = next(existing, None)
+            else:
+                nodes.append(self._new_node(key, element))
+        while node is not None:
+            nodes.append(node)
+            node = next(existing, None)
+
+        self.root = build_balanced(*chain_nodes(nodes))
+        self.reindex()
+        return self
+
+    def _new_node(self, key, element):
+        if self.keyfunc is None:
+            return self.node_class(key)
+        return AVLMapNode(key, element)
+
+    def _check_elements(self, other):
+        # Elements taken in from other must be ordered by this tree's key
+        # function, so both trees need the same one (or neither has one)
+        if getattr(other, 'keyfunc', None) is not self.keyfunc:
+            raise TypeError("Can't combine the elements of trees with "
+                            "different key functions")
+
+    def _copy_pairs(self, pairs):
+        # Build a new tree like this one from sorted (key, element) pairs
+        tree = AVLTree(key=self.keyfunc, hash_index=self.index is not None)
+        tree.root = build_balanced(*chain_nodes(
+            AVLMapNode(key, element) for key, element in pairs))
+        tree.reindex()
+        return tree
 
+    def _copy_nodes(self, nodes):
+        # Build a new tree from copies of sorted nodes, reusing their
+        # extracted keys
+        if self.keyfunc is None:
+            return AVLTree.from_sorted((node.key for node in nodes),
+                                       hash_index=self.index is not None)
+        tree = AVLTree(key=self.keyfunc, hash_index=self.index is not None)
+        tree.root = build_balanced(*chain_nodes(
+            AVLMapNode(node.key, node.value) for node in nodes))
+        tree.reindex()
+        return tree
 
-    def delete(self, key):
-        if self.root is None:
-            raise KeyError('Tree is empty')
+    def _common_nodes(self, other):
+        '''
+        Yield this tree's nodes whose keys are also in other, searching
+        from the smaller side when the sizes are far apart
+        '''
+        n, m = len(self), len(other)
+        if n <= m and search_is_cheaper(n, m):
+            lookup = sorted_lookup(other)
+            return (node for node in self.traverse() if lookup(node.key))
+        elif m < n and search_is_cheaper(m, n):
+            lookup = sorted_lookup(self)
+            return filter(None, map(lookup, other.keys()))
+        return self._merge_with_keys(other, True)
+
+    def _unique_nodes(self, other):
+        'Yield this tree\'s nodes whose keys are not in other'
+        if search_is_cheaper(len(self), len(other)):
+            lookup = sorted_lookup(other)
+            return (node for node in self.traverse() if not lookup(node.key))
+        return self._merge_with_keys(other, False)
+
+    def _merge_with_keys(self, other, common):
+        # This tree's nodes whose keys are (or, unless common, are not)
+        # also in other
+        nodes = ((node.key, node) for node in self.traverse())
+        keys = ((key, None) for key in other.keys())
+        merged = merge_sorted(nodes, keys, not common, common, False,
+                              key=itemgetter(0))
+        return (node for _, node in merged)
+
+
+class AVLMap(AVLTree, MutableMapping):
+
+    '''
+    A sorted mapping, storing each value on the node holding its key.
+    keys, values and items return views in key order. Set operators
+    combine maps by key: union and symmetric difference take the entries
+    of another mapping, with its values winning on shared keys as in dict
+    union, while intersection and difference keep this map's values.
+    '''
+    node_class = AVLMapNode
+
+    def __init__(self, items=None, hash_index=False):
+        super().__init__(hash_index=hash_index)
+        if items:
+            self._relink(sorted(dict(items).items()))
+
+    def _relink(self, items):
+        # Rebuild the tree from (key, value) pairs in strictly increasing
+        # key order
+        self.root = build_balanced(*chain_nodes(AVLMapNode(key, value)
+                                                for key, value in items))
+        self.reindex()
+
+    def __getitem__(self, key):
+        return self.find_node(key).value
 
-        ancestors = self.path_to_root(key)
-        node = ancestors.pop()
+    def __iter__(self):
+        return AVLTree.keys(self)
+
+    def dump(self, fileobj):
+        write_snapshot(fileobj, self.keys(), self.values())
 
+    def read_snapshot(self, fileobj):
+        self._relink(read_snapshot(fileobj, values=True))
 
-        if node.is_leaf():
-            self.delleaf(node, ancestors)
-        elif node.right is None:
-            self.del1childl(node, ancestors)
-        elif node.left is None:
-            self.del1childr(node, ancestors)
+    def __setitem__(self, key, value):
+        node, found = self.locate(key)
+        if found:
+            node.value = value
         else:
-            self.del2child(node, ancestors)
+            self.attach(node, AVLMapNode(key, value))
 
-    def delleaf(self, node, ancestors):
-        ancestor = ancestors.peek()
-        if node is self.root:
-            self.root = None
-            return
+    def __delitem__(self, key):
+        if isinstance(key, slice):
+            super().__delitem__(key)
+        else:
+            self.delete(key)
 
-        elif node.key > ancestor.key:
-            ancestor.right = None
-        else: 
-            ancestor.left = None
+    def setdefault(self, key, default=None):
+        node, found = self.locate(key)
+        if found:
+            return node.value
+        self.attach(node, AVLMapNode(key, default))
+        return default
 
-        for ancestor in ancestors:
-            self.rebalance_node(ancestor)
+    def clear(self):
+        self.root = None
+        self.reindex()
 
-    def del1childl(self, node, ancestors):
-        if self.root is node:
-            self.root = node.left
-            node.left.update_height()
-            return
+    def keys(self):
+        return KeysView(self)
 
-        ancestor = ancestors.peek()
-        child = node.left
-        child.parent = ancestor
-        if child.key > ancestor.key:
-            ancestor.right = child
-        else:
-            ancestor.left = child
-
-        for ancestor in ancestors:
-            self.rebalance_node(ancestor)
-
-    def del1childr(self, node, ancestors):
-        if self.root is node:
-            self.root = node.right
-            node.right.update_height()
-        
-        ancestor = ancestors.peek()
-        child = node.right    
-        child.parent = ancestor
-        if child.key > ancestor.key:
-            ancestor.right = child
+    def values(self):
+        return AVLMapValuesView(self)
+
+    def items(self):
+        return AVLMapItemsView(self)
+
+    def _copy_nodes(self, nodes):
+        tree = AVLMap(hash_index=self.index is not None)
+        tree._relink((node.key, node.value) for node in nodes)
+        return tree
+
+    def _merged_items(self, other, both):
+        # Merge with another mapping's items, keeping shared keys (with
+        # other's values) when both is set
+        if not isinstance(other, Mapping):
+            raise TypeError('An AVLMap can only be combined with a mapping')
+        items = (other.items() if isinstance(other, AVLMap) else
+                 sorted(other.items(), key=itemgetter(0)))
+        return merge_sorted(items, self.items(), True, both, True,
+                            key=itemgetter(0))
+
+    def union(self, other):
+        tree = AVLMap(hash_index=self.index is not None)
+        tree._relink(self._merged_items(other, True))
+        return tree
+
+    def _sorted_keys(self, other):
+        # The key-only operations read other's keys in order and search
+        # it, so a mapping that isn't a tree has its keys put in one
+        if isinstance(other, Mapping) and not isinstance(other, AVLTree):
+            return AVLTree.from_keys(other)
+        return other
+
+    def intersection(self, other):
+        return self._copy_nodes(self._common_nodes(self._sorted_keys(other)))
+
+    def difference(self, other):
+        return super().difference(self._sorted_keys(other))
+
+    def symmetric_difference(self, other):
+        tree = AVLMap(hash_index=self.index is not None)
+        tree._relink(self._merged_items(other, False))
+        return tree
+
+    def issubset(self, other):
+        return super().issubset(self._sorted_keys(other))
+
+    def issuperset(self, other):
+        return super().issuperset(self._sorted_keys(other))
+
+    def isdisjoint(self, other):
+        return super().isdisjoint(self._sorted_keys(other))
+
+    __or__ = union
+    __and__ = intersection
+    __sub__ = difference
+    __xor__ = symmetric_difference
+
+    def __ior__(self, other):
+        if not isinstance(other, Mapping):
+            raise TypeError('An AVLMap can only be combined with a mapping')
+        self.update(other)
+        return self
+
+    def __iand__(self, other):
+        return super().__iand__(self._sorted_keys(other))
+
+    def __isub__(self, other):
+        return super().__isub__(self._sorted_keys(other))
+
+    def __ixor__(self, other):
+        self._relink(list(self._merged_items(other, False)))
+        return self
+
+
+class AVLMapValuesView(ValuesView):
+
+    'The values of an AVLMap in key order, read straight from the nodes'
+    __slots__ = ()
+
+    def __iter__(self):
+        yield from (node.value for node in self._mapping.traverse())
+
+
+class AVLMapItemsView(ItemsView):
+
+    'The (key, value) pairs of an AVLMap in key order'
+    __slots__ = ()
+
+    def __iter__(self):
+        yield from ((node.key, node.value)
+                    for node in self._mapping.traverse())
+
+
+class Cursor(object):
+
+    '''
+    A position in a tree that steps to neighbouring keys in amortized O(1)
+    time. A cursor stays valid while other keys are inserted or deleted,
+    but not once its own key is deleted.
+    '''
+    __slots__ = ['tree', 'node']
+
+    def __init__(self, tree, node=None):
+        self.tree = tree
+        self.node = node
+
+    def __repr__(self):
+        return 'Cursor({})'.format(self.node.key if self.node else '')
+
+    def __bool__(self):
+        return self.node is not None
+
+    @property
+    def key(self):
+        if self.node is None:
+            raise KeyError('Cursor is not on a key')
+        return self.node.key
+
+    def seek(self, key):
+        '''
+        Move to the smallest key greater than or equal to key, returning
+        whether key itself was found. Past the maximum the cursor is left
+        off the tree.
+        '''
+        try:
+            self.node = self.tree.bound_node(key, below=False, inclusive=True)
+        except KeyError:
+            self.node = None
+            return False
+        return self.node.key == key
+
+    def _step(self, step):
+        if self.node is None:
+            raise KeyError('Cursor is not on a key')
+        node = step(self.node)
+        if node is None:
+            raise KeyError('No key {} {}'.format(
+                'after' if step is next_node else 'before', self.node.key))
+        self.node = node
+        return node.key
+
+    def next(self):
+        'Move to the next key and return it'
+        return self._step(next_node)
+
+    def prev(self):
+        'Move to the previous key and return it'
+        return self._step(prev_node)
+
+
+# Bulk query helpers
+
+
+def _bound_key(node, key, default):
+    if node is not None:
+        return node.key
+    if default is MISSING:
+        raise KeyError('No bound for key: {}'.format(key))
+    return default
+
+
+def _take(column, index, keys, default):
+    # column[i] for each i in index, with out of range positions replaced
+    # by default
+    n = len(column)
+    if isinstance(column, list):
+        results = []
+        for key, i in zip(keys, index):
+            if 0 <= i < n:
+                results.append(column[i])
+            elif default is MISSING:
+                raise KeyError('No bound for key: {}'.format(key))
+            else:
+                results.append(default)
+        return results
+
+    missing = (index < 0) | (index >= n)
+    values = column[index.clip(0, n - 1)]
+    if not missing.any():
+        return values
+    if default is MISSING:
+        raise KeyError('No bound for key: {}'.format(keys[missing.argmax()]))
+    return np.where(missing, default, values)
+
+
+# Sorted key stream functions
+
+
+def search_is_cheaper(m, n):
+    '''
+    Whether m finger descents into a tree of n keys, of about log(n / m)
+    steps each, beat a linear pass over all n + m keys
+    '''
+    if m == 0:
+        return True
+    finger_cost = m * (log2(n / m + 1) + FINGER_OVERHEAD)
+    return finger_cost <= REBUILD_COST * (n + m)
+
+
+def sorted_lookup(tree):
+    '''
+    Return a function for looking up a run of increasing keys in tree. For
+    an AVLTree it returns the matching node or None, starting each descent
+    from the previous position; other trees just answer `in`.
+    '''
+    if not isinstance(tree, AVLTree):
+        return tree.contains_key
+    if tree.index is not None:
+        return tree.index.get
+
+    finger = None
+
+    def lookup(key):
+        nonlocal finger
+        start = tree.climb(finger, key) if finger is not None else None
+        node, found = tree.locate(key, start)
+        if node is not None:
+            finger = node
+        return node if found else None
+
+    return lookup
+
+
+def covers(big, small):
+    'Whether every key of small is in big, stopping at the first miss'
+    if len(small) > len(big):
+        return False
+    if search_is_cheaper(len(small), len(big)):
+        lookup = sorted_lookup(big)
+        return all(lookup(key) for key in small.keys())
+
+    missing = merge_sorted(big.keys(), small.keys(), False, False, True)
+    return next(missing, None) is None
+
+
+def key_element_pairs(tree):
+    'Yield (key, element) pairs of any tree in key order'
+    if getattr(tree, 'keyfunc', None) is not None:
+        return ((node.key, node.value) for node in tree.traverse())
+    return ((key, key) for key in tree.keys())
+
+
+def merge_sorted(a, b, left, both, right, key=None):
+    '''
+    Lazily merge two strictly increasing iterables. Items only in a, in
+    both (taken from a), or only in b are yielded when left, both or right
+    is set. With key, items are ordered by key(item), as in sorted.
+    '''
+    a, b = iter(a), iter(b)
+    end = object()
+    x, y = next(a, end), next(b, end)
+    kx = x if key is None or x is end else key(x)
+    ky = y if key is None or y is end else key(y)
+
+    while x is not end and y is not end:
+        if kx < ky:
+            if left:
+                yield x
+            x = next(a, end)
+            kx = x if key is None or x is end else key(x)
+        elif ky < kx:
+            if right:
+                yield y
+            y = next(b, end)
+            ky = y if key is None or y is end else key(y)
         else:
-            ancestor.left = child
+            if both:
+                yield x
+            x, y = next(a, end), next(b, end)
+            kx = x if key is None or x is end else key(x)
+            ky = y if key is None or y is end else key(y)
 
-        for ancestor in ancestors:
-            self.rebalance_node(ancestor)
+    if x is not end and left:
+        yield x
+        yield from a
+    elif y is not end and right:
+        yield y
+        yield from b
 
-    def del2child(self, node, ancestors):
-        # Find a replacement for the node to be deleted
-        replacement = node.left
-        while replacement.right:
-            replacement = replacement.right
 
-        path_to_replacement = self.path_to_root(replacement.key)
-        path_to_replacement.pop() # Remove replacement from stack
+def merge_union(a, b):
+    'Lazily merge two strictly increasing iterables, dropping duplicates'
+    return merge_sorted(a, b, True, True, True)
 
-        self.delete(replacement.key)
 
-        # The parent of the node to be deleted
-        direct_ancestor = ancestors.peek()
-                
-        replacement.children = node.children 
-        replacement.parent = direct_ancestor
-        replacement.update_height()
+def merge_intersection(a, b):
+    'Lazily yield the keys common to two strictly increasing iterables'
+    return merge_sorted(a, b, False, True, False)
+
+# Node manipulation functions
+
+
+def height(node):
+    return node.height if node is not None else 0
+
+
+def rebalance(node):
+    '''
+    Update node's height and restore its balance with rotations, returning
+    the root of the resulting subtree
+    '''
+    # Heights are read inline: this runs at every level of every retrace
+    left, right = node.left, node.right
+    if left is None:
+        lheight, lsize = 0, 0
+    else:
+        lheight, lsize = left.height, left.size
+    if right is None:
+        rheight, rsize = 0, 0
+    else:
+        rheight, rsize = right.height, right.size
+    node.height = (lheight if lheight > rheight else rheight) + 1
+    node.size = lsize + rsize + 1
+
+    if rheight - lheight > 1:
+        if height(right.left) > height(right.right):
+            new_root = right.left
+            rotate_double_left(node)
 
-        if node is self.root:
-            self.root = replacement
-        
-        elif replacement.key > direct_ancestor.key:
-            direct_ancestor.right = replacement
         else:
-            direct_ancestor.left = replacement
+            new_root = right
+            rotate_left(node)
 
-        for ancestor in path_to_replacement:
-            self.rebalance_node(ancestor)
+    elif lheight - rheight > 1:
+        if height(left.right) > height(left.left):
+            new_root = left.right
+            rotate_double_right(node)
 
-    def min_node(self, start=None):
-        if not self.root:
-            raise KeyError('Tree empty!')
-        if not start:
-            node = self.root
         else:
-            node = start
+            new_root = left
+            rotate_right(node)
+
+    else:
+        return node
+
+    return new_root
+
+
+def join_nodes(left, mid, right):
+    '''
+    Join two detached subtrees and a node whose key lies between them into
+    one balanced subtree, returning its root. Costs O(|height difference|).
+    '''
+    if height(left) > height(right) + 1:
+        # Walk down the taller side's right spine to a subtree that mid
+        # can pair with right, then rebalance back up the spine
+        spine = left
+        while height(spine.right) > height(right) + 1:
+            spine = spine.right
+        mid.left, mid.right = spine.right, right
+        spine.right = mid
+        mid.parent = spine
+    elif height(right) > height(left) + 1:
+        spine = right
+        while height(spine.left) > height(left) + 1:
+            spine = spine.left
+        mid.left, mid.right = left, spine.left
+        spine.left = mid
+        mid.parent = spine
+    else:
+        mid.left, mid.right = left, right
+        mid.parent = spine = None
+
+    for child in mid.children:
+        if child is not None:
+            child.parent = mid
+    mid.update_height()
+
+    root = mid
+    node = spine
+    while node is not None:
+        root = rebalance(node)
+        node = root.parent
+    return root
+
+
+def join_pair(left, right):
+    '''
+    Join two detached subtrees, where every key in left is less than every
+    key in right, returning the new root
+    '''
+    if left is None:
+        return right
+    if right is None:
+        return left
+
+    rest = AVLTree()
+    rest.root = right
+    mid = rest.min_node()
+    rest.delete_node(mid)
+    return join_nodes(left, mid, rest.root)
+
+
+def split_nodes(root, key):
+    '''
+    Split a detached subtree into subtrees of the keys less than key and
+    of the rest, returning both roots. Costs O(log n).
+    '''
+    if root is None:
+        return None, None
+
+    left, right = root.left, root.right
+    for child in (left, right):
+        if child is not None:
+            child.parent = None
+    root.left = root.right = root.parent = None
+
+    if root.key < key:
+        below, above = split_nodes(right, key)
+        return join_nodes(left, root, below), above
+    else:
+        below, above = split_nodes(left, key)
+        return below, join_nodes(above, root, right)
+
 
+def next_node(node):
+    'Return the in-order successor of node, or None'
+    if node.right is not None:
+        node = node.right
         while node.left is not None:
             node = node.left
+        return node
+
+    while node.parent is not None and node is node.parent.right:
+        node = node.parent
+    return node.parent
 
+
+def prev_node(node):
+    'Return the in-order predecessor of node, or None'
+    if node.left is not None:
+        node = node.left
+        while node.right is not None:
+            node = node.right
         return node
 
-    def min(self):
-        return self.min_node().key
+    while node.parent is not None and node is node.parent.left:
+        node = node.parent
+    return node.parent
 
-    def max_node(self, start=None):
-        if not self.root:
-            raise KeyError('Tree empty!')
-        if not start:
-            node = self.root
+
+# Descents from a root, reading only key, left, right and size, for trees
+# whose nodes have no parent pointers, such as PersistentAVLTree. AVLTree
+# keeps its own copies of these loops inline, as the extra call costs 5-10%
+# on its point lookups.
+
+
+def search(root, key):
+    'Return the node holding key under root, or None'
+    node = root
+    while node is not None:
+        if key > node.key:
+            node = node.right
+        elif key < node.key:
+            node = node.left
         else:
-            node = start
+            return node
+    return None
+
+
+def bound(root, key, below, inclusive):
+    '''
+    Return the node under root with the closest key below (or above) key,
+    or None. The node holding key itself qualifies only when inclusive.
+    '''
+    best = None
+    node = root
+    while node is not None:
+        if key > node.key:
+            if below:
+                best = node
+            node = node.right
+        elif key < node.key:
+            if not below:
+                best = node
+            node = node.left
+        elif inclusive:
+            return node
+        else:
+            node = node.left if below else node.right
+    return best
 
-        while node.right is not None:
+
+def rank_under(root, key):
+    'Return the number of keys under root less than key'
+    rank = 0
+    node = root
+    while node is not None:
+        if key > node.key:
+            rank += node.left.size + 1 if node.left is not None else 1
             node = node.right
+        elif key < node.key:
+            node = node.left
+        else:
+            rank += node.left.size if node.left is not None else 0
+            break
+    return rank
 
-        return node
 
-    def max(self):
-        return self.max_node().key
+def select_under(root, index):
+    'Return the node holding the index-th smallest key under root'
+    node = root
+    while True:
+        lsize = node.left.size if node.left is not None else 0
+        if index < lsize:
+            node = node.left
+        elif index > lsize:
+            index -= lsize + 1
+            node = node.right
+        else:
+            return node
 
-    def intersection(self, other):
-        t1 = Stack(self.traverse(reverse=True))
-        t2 = Stack(other.traverse(reverse=True))
-
-        a, b = t1.pop(), t2.pop()
-
-        ntree = AVLTree()
-        while a is not None and b is not None:
-            if a.key == b.key:
-                ntree.insert(a.key)
-                a, b = t1.pop(), t2.pop()
-            elif a.key < b.key:
-                a = t1.pop()
-            else:
-                b = t2.pop()
 
-        return ntree
+def leftmost(node):
+    while node.left is not None:
+        node = node.left
+    return node
 
-    def union(self, other):
-        t1 = Stack(self.traverse(reverse=True))
-        t2 = Stack(other.traverse(reverse=True))
 
-        a, b = t1.pop(), t2.pop()
+def rightmost(node):
+    while node.right is not None:
+        node = node.right
+    return node
 
-        ntree = AVLTree()
 
-        while a is not None or b is not None:
-            if a is None:
-                ntree.insert(b.key)
-                b = t2.pop()
+def chain_nodes(nodes):
+    '''
+    Link an iterable of nodes in increasing key order through their right
+    pointers. Returns the head of the chain and its length.
+    '''
+    head = tail = None
+    count = 0
+    for node in nodes:
+        if tail is None:
+            head = node
+        elif not node.key > tail.key:
+            raise ValueError("Can't add node for key: {}".format(node.key))
+        else:
+            tail.right = node
+        tail = node
+        count += 1
 
-            elif b is None:
-                ntree.insert(a.key)
-                a = t1.pop()
+    if tail is not None:
+        tail.right = None
+    return head, count
 
-            elif a.key == b.key:
-                ntree.insert(a.key)
-                a, b = t1.pop(), t2.pop()
 
-            elif a.key < b.key:
-                ntree.insert(a.key)
-                a = t1.pop()
+def build_balanced(head, count):
+    '''
+    Build a perfectly balanced tree from the first count nodes of a chain
+    made by chain_nodes. Runs in O(n) and returns the new root.
+    '''
+    chain = head
 
-            else:
-                ntree.insert(b.key)
-                b = t2.pop()
+    def build(n):
+        nonlocal chain
+        if n == 0:
+            return None
 
-        return ntree
+        nleft = (n - 1) // 2
+        left = build(nleft)
+
+        node = chain
+        chain = node.right
+
+        node.left = left
+        node.right = build(n - nleft - 1)
+        if node.left is not None:
+            node.left.parent = node
+        if node.right is not None:
+            node.right.parent = node
+        node.update_height()
+        return node
+
+    root = build(count)
+    if root is not None:
+        root.parent = None
+    return root
 
-# Node manipulation functions
 
 
 def rotate_right(root):
@@ -0,0 +1,182 @@
+import mmap
+import struct
+import sys
+from array import array
+from bisect import bisect_left, bisect_right
+
+from .avl import AVLTree, merge_union, merge_intersection
+
+# A frozen tree file is a fixed-size header followed by the sorted keys as
+# one packed column of int64 or float64 values in native byte order. The
+# header is padded so the column starts 8-byte aligned.
+
+MAGIC = b'AVLF'
+VERSION = 1
+HEADER = struct.Struct('<4sBcc25xQ')
+TYPECODES = {int: 'q', float: 'd'}
+BYTEORDERS = {'little': b'<', 'big': b'>'}
+
+
+class FrozenAVLTree(object):
+
+    '''
+    A read-only tree over a sorted column of fixed-width keys, answering
+    queries by binary search. Opened from a file the column is memory
+    mapped, so processes opening the same file share one copy in the page
+    cache and start up without building any nodes.
+    '''
+
+    def __init__(self, keys, mapping=None):
+        self._keys = keys
+        self._mmap = mapping
+
+    @classmethod
+    def from_sorted(cls, keys, path=None):
+        '''
+        Freeze strictly increasing int or float keys, in memory or, given
+        a path, into a file that is then opened memory mapped
+        '''
+        keys = iter(keys)
+        first = next(keys, None)
+        if first is None:
+            typecode = 'q'
+        elif type(first) in TYPECODES:
+            typecode = TYPECODES[type(first)]
+        else:
+            raise TypeError('Only int and float keys can be frozen, not '
+                            '{}'.format(type(first).__name__))
+
+        column = array(typecode)
+        if first is not None:
+            column.append(first)
+        for key in keys:
+            if not key > column[-1]:
+                raise ValueError('Keys must be strictly increasing: '
+                                 '{}'.format(key))
+            column.append(key)
+
+        if path is None:
+            return cls(memoryview(column))
+
+        with open(path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, VERSION, typecode.encode(),
+                                BYTEORDERS[sys.byteorder], len(column)))
+            column.tofile(f)
+        return cls.open(path)
+
+    @classmethod
+    def open(cls, path):
+        'Open a file written by freeze, memory mapped read-only'
+        with open(path, 'rb') as f:
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, typecode, byteorder, count = \
+            HEADER.unpack_from(mapping)
+        if magic != MAGIC or version != VERSION:
+            mapping.close()
+            raise ValueError('Not a frozen AVL tree file: {}'.format(path))
+        if byteorder != BYTEORDERS[sys.byteorder]:
+            mapping.close()
+            raise ValueError('Frozen tree was written with the other byte order')
+
+        typecode = typecode.decode()
+        end = HEADER.size + count * array(typecode).itemsize
+        keys = memoryview(mapping)[HEADER.size:end].cast(typecode)
+        return cls(keys, mapping)
+
+    def close(self):
+        self._keys.release()
+        if self._mmap is not None:
+            self._mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __contains__(self, key):
+        i = bisect_left(self._keys, key)
+        return i < len(self._keys) and self._keys[i] == key
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __iter__(self):
+        return self.keys()
+
+    def __getitem__(self, index):
+        return self.select(index)
+
+    def size(self):
+        return len(self)
+
+    def keys(self):
+        yield from self._keys
+
+    elements = keys
+
+    def contains_key(self, key):
+        return key in self
+
+    def min(self):
+        if not self._keys:
+            raise KeyError('Tree empty!')
+        return self._keys[0]
+
+    def max(self):
+        if not self._keys:
+            raise KeyError('Tree empty!')
+        return self._keys[-1]
+
+    def rank(self, key):
+        return bisect_left(self._keys, key)
+
+    def select(self, index):
+        n = len(self._keys)
+        if not -n <= index < n:
+            raise IndexError('Tree index out of range: {}'.format(index))
+        return self._keys[index]
+
+    def irange(self, lo=None, hi=None, inclusive=(True, False), reverse=False):
+        keys = self._keys
+        lo_inclusive, hi_inclusive = inclusive
+        if lo is None:
+            start = 0
+        else:
+            start = (bisect_left if lo_inclusive else bisect_right)(keys, lo)
+        if hi is None:
+            stop = len(keys)
+        else:
+            stop = (bisect_right if hi_inclusive else bisect_left)(keys, hi)
+
+        if reverse:
+            for i in range(stop - 1, start - 1, -1):
+                yield keys[i]
+        else:
+            for i in range(start, stop):
+                yield keys[i]
+
+    def _at(self, i, key, below):
+        if not 0 <= i < len(self._keys):
+            raise KeyError('No key {} {}'.format('below' if below else 'above',
+                                                 key))
+        return self._keys[i]
+
+    def floor(self, key):
+        return self._at(bisect_right(self._keys, key) - 1, key, True)
+
+    def ceiling(self, key):
+        return self._at(bisect_left(self._keys, key), key, False)
+
+    def predecessor(self, key):
+        return self._at(bisect_left(self._keys, key) - 1, key, True)
+
+    def successor(self, key):
+        return self._at(bisect_right(self._keys, key), key, False)
+
+    def intersection(self, other):
+        return AVLTree.from_sorted(merge_intersection(self.keys(), other.keys()))
+
+    def union(self, other):
+        return AVLTree.from_sorted(merge_union(self.keys(), other.keys()))
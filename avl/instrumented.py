@@ -0,0 +1,214 @@
+'''
+An AVLTree that records what its operations cost: key comparisons, nodes
+visited, rebalancing steps, rotations by kind and latency histograms, per
+operation type.
+
+Everything is done in a subclass, so plain AVLTree runs exactly as before
+and pays nothing. Comparisons are counted by handing the descent loops a
+CountingKey in place of the key, so the loops themselves are unchanged.
+'''
+from time import perf_counter_ns
+
+from .avl import AVLTree, height, rebalance
+
+
+class CountingKey(object):
+
+    '''
+    Stands in for a key during a descent, adding each comparison to an
+    operation's counters. A run of comparisons against the same node key
+    counts as one node visited.
+    '''
+    __slots__ = ['key', 'counters', 'last']
+
+    def __init__(self, key, counters):
+        self.key = key
+        self.counters = counters
+        self.last = self
+
+    def _count(self, other):
+        counters = self.counters
+        counters['comparisons'] += 1
+        if other is not self.last:
+            counters['nodes_visited'] += 1
+            self.last = other
+
+    def __lt__(self, other):
+        self._count(other)
+        return self.key < other
+
+    def __gt__(self, other):
+        self._count(other)
+        return self.key > other
+
+    def __le__(self, other):
+        self._count(other)
+        return self.key <= other
+
+    def __ge__(self, other):
+        self._count(other)
+        return self.key >= other
+
+    def __eq__(self, other):
+        self._count(other)
+        return self.key == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __repr__(self):
+        return repr(self.key)
+
+    def __format__(self, spec):
+        return format(self.key, spec)
+
+
+def new_counters():
+    return {
+        'calls': 0,
+        'comparisons': 0,
+        'nodes_visited': 0,
+        'rebalances': 0,
+        'rotations': {'left': 0, 'right': 0,
+                      'double_left': 0, 'double_right': 0},
+        # Upper bound in microseconds (a power of two) -> calls
+        'latency_us': {},
+    }
+
+
+def rotation(node):
+    'The rotation rebalance is about to apply at node, or None'
+    lheight, rheight = height(node.left), height(node.right)
+    if rheight - lheight > 1:
+        if height(node.right.left) > height(node.right.right):
+            return 'double_left'
+        return 'left'
+    elif lheight - rheight > 1:
+        if height(node.left.right) > height(node.left.left):
+            return 'double_right'
+        return 'right'
+    return None
+
+
+def _measured(name, method):
+    '''
+    Wrap method to count calls and time them under name. Nested calls,
+    such as the locate inside insert, count towards the outer operation.
+    '''
+    def measured(self, *args, **kwargs):
+        if self._counters is not None:
+            return method(self, *args, **kwargs)
+
+        counters = self.stats.get(name)
+        if counters is None:
+            counters = self.stats[name] = new_counters()
+        counters['calls'] += 1
+        self._counters = counters
+        start = perf_counter_ns()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self._counters = None
+            bucket = 1 << ((perf_counter_ns() - start) // 1000).bit_length()
+            latency = counters['latency_us']
+            latency[bucket] = latency.get(bucket, 0) + 1
+    measured.__name__ = name
+    return measured
+
+
+class InstrumentedAVLTree(AVLTree):
+
+    '''
+    An AVLTree that counts the work done by each type of operation.
+    metrics() returns the counts as a plain dict, along with the current
+    height and size; reset_metrics() starts them over. Rotations made by
+    split and join are not counted, as they do not go through retrace.
+    '''
+    _counters = None
+
+    def __init__(self, key=None, hash_index=False):
+        super().__init__(key=key, hash_index=hash_index)
+        self.reset_metrics()
+
+    def reset_metrics(self):
+        self.stats = {}
+
+    def metrics(self):
+        return {
+            'height': self.root.height if self.root is not None else 0,
+            'size': len(self),
+            'operations': {
+                name: dict(counters,
+                           rotations=dict(counters['rotations']),
+                           latency_us=dict(sorted(
+                               counters['latency_us'].items())))
+                for name, counters in self.stats.items()},
+        }
+
+    def _with_root(self, root):
+        tree = super()._with_root(root)
+        tree.reset_metrics()
+        return tree
+
+    def _probe(self, key):
+        if self._counters is None:
+            return key
+        return CountingKey(key, self._counters)
+
+    def _contains(self, key):
+        if self.keyfunc is not None:
+            return self.contains_key(self.keyfunc(key))
+        return AVLTree.__contains__(self, self._probe(key))
+
+    def _find_node(self, key):
+        return AVLTree.find_node(self, self._probe(key))
+
+    def _path_to_root(self, key):
+        return AVLTree.path_to_root(self, self._probe(key))
+
+    def locate(self, key, start=None):
+        return AVLTree.locate(self, self._probe(key), start)
+
+    def retrace(self, node, delta):
+        counters = self._counters
+        if counters is None:
+            return AVLTree.retrace(self, node, delta)
+
+        # AVLTree.retrace, counting each rebalance and rotation
+        rotations = counters['rotations']
+        while node is not None:
+            old_height = node.height
+            kind = rotation(node)
+            if kind is not None:
+                rotations[kind] += 1
+            counters['rebalances'] += 1
+            subtree = rebalance(node)
+            if node is self.root:
+                self.root = subtree
+            node = subtree.parent
+            if subtree.height == old_height:
+                break
+
+        while node is not None:
+            node.size += delta
+            node = node.parent
+
+    def rebalance_node(self, node):
+        if self._counters is not None:
+            kind = rotation(node)
+            if kind is not None:
+                self._counters['rotations'][kind] += 1
+            self._counters['rebalances'] += 1
+        return AVLTree.rebalance_node(self, node)
+
+    __contains__ = _measured('__contains__', _contains)
+    find_node = _measured('find_node', _find_node)
+    path_to_root = _measured('path_to_root', _path_to_root)
+    contains_key = _measured('contains_key', AVLTree.contains_key)
+    insert = _measured('insert', AVLTree.insert)
+    delete = _measured('delete', AVLTree.delete)
+    insert_many = _measured('insert_many', AVLTree.insert_many)
+    delete_many = _measured('delete_many', AVLTree.delete_many)
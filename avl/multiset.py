@@ -0,0 +1,339 @@
+'''
+A sorted multiset. Each distinct key has one node, which counts its
+occurrences, so heavily repeated keys cost no more space or comparisons
+than a single key.
+
+Nodes also keep the total count under them, alongside the node count in
+size. The AVLTree machinery keeps managing size, heights and balance; the
+multiset refreshes totals on the retrace path after each update, and in
+full whenever the tree is relinked wholesale.
+'''
+from itertools import repeat
+from operator import itemgetter
+
+from .avl import AVLNode, AVLTree, build_balanced, chain_nodes, rebalance
+from .snapshot import read_snapshot, write_snapshot
+
+
+class AVLMultisetNode(AVLNode):
+
+    'A tree node holding count occurrences of its key'
+    __slots__ = ['count', 'total']
+
+    def __init__(self, key, count=1):
+        super().__init__(key)
+        self.count = count
+        self.total = count
+
+
+def total(node):
+    return node.total if node is not None else 0
+
+
+def retotal(node):
+    'Recompute the totals of every node under node, returning its own'
+    if node is None:
+        return 0
+    node.total = retotal(node.left) + retotal(node.right) + node.count
+    return node.total
+
+
+def refresh_total(node):
+    node.total = total(node.left) + total(node.right) + node.count
+
+
+def run_lengths(keys):
+    'Collapse sorted keys into (key, count) pairs'
+    keys = iter(keys)
+    end = object()
+    key = next(keys, end)
+    while key is not end:
+        count = 1
+        following = next(keys, end)
+        while following is not end and following == key:
+            count += 1
+            following = next(keys, end)
+        yield key, count
+        key = following
+
+
+def counted(tree):
+    'The (key, count) pairs of a multiset, or of any tree as count 1 each'
+    if isinstance(tree, AVLMultiset):
+        return tree.items()
+    return ((key, 1) for key in tree.keys())
+
+
+def merge_counts(a, b, combine):
+    '''
+    Merge two sorted streams of (key, count) pairs, yielding each key with
+    combine(count in a, count in b) wherever that is positive
+    '''
+    a, b = iter(a), iter(b)
+    end = object()
+    x, y = next(a, end), next(b, end)
+    while x is not end or y is not end:
+        if y is end or (x is not end and x[0] < y[0]):
+            key, count = x[0], combine(x[1], 0)
+            x = next(a, end)
+        elif x is end or y[0] < x[0]:
+            key, count = y[0], combine(0, y[1])
+            y = next(b, end)
+        else:
+            key, count = x[0], combine(x[1], y[1])
+            x, y = next(a, end), next(b, end)
+        if count > 0:
+            yield key, count
+
+
+def subtract(x, y):
+    return x - y
+
+
+def distance(x, y):
+    return abs(x - y)
+
+
+class AVLMultiset(AVLTree):
+
+    '''
+    A sorted collection of keys that may repeat. add and remove change a
+    key's count in O(log n), where n is the number of distinct keys; len,
+    rank, select and iteration count every occurrence. keys, irange and
+    the neighbour queries see each distinct key once, and delete removes
+    every occurrence of a key. Set algebra follows multiset rules: union
+    and intersection take the larger and smaller count of each key.
+
+    Key functions are not supported. split and join refresh the totals in
+    O(n).
+    '''
+    node_class = AVLMultisetNode
+
+    def __init__(self, keys=None, hash_index=False):
+        super().__init__(hash_index=hash_index)
+        if keys:
+            self._build(run_lengths(sorted(keys)))
+
+    @classmethod
+    def from_keys(cls, keys, hash_index=False):
+        return cls(keys, hash_index=hash_index)
+
+    @classmethod
+    def from_counts(cls, counts, hash_index=False):
+        'Build from a mapping or from (key, count) pairs'
+        if hasattr(counts, 'items'):
+            counts = counts.items()
+        merged = []
+        for key, count in sorted(counts, key=itemgetter(0)):
+            if count < 0:
+                raise ValueError('Negative count for key: {}'.format(key))
+            if merged and merged[-1][0] == key:
+                merged[-1][1] += count
+            else:
+                merged.append([key, count])
+
+        tree = cls(hash_index=hash_index)
+        tree._build((key, count) for key, count in merged if count)
+        return tree
+
+    @classmethod
+    def from_array(cls, array, hash_index=False):
+        return cls(getattr(array, 'tolist', lambda: array)(),
+                   hash_index=hash_index)
+
+    def _build(self, pairs):
+        self.root = build_balanced(*chain_nodes(
+            AVLMultisetNode(key, count) for key, count in pairs))
+        self.reindex()
+
+    def reindex(self):
+        super().reindex()
+        retotal(self.root)
+
+    def _with_root(self, root):
+        tree = super()._with_root(root)
+        retotal(tree.root)
+        return tree
+
+    def dump(self, fileobj):
+        write_snapshot(fileobj, self.keys(),
+                       (node.count for node in self.traverse()))
+
+    def read_snapshot(self, fileobj):
+        self._build(read_snapshot(fileobj, values=True))
+
+    def __len__(self):
+        return self.root.total if self.root is not None else 0
+
+    def elements(self):
+        'Yield every occurrence in order, expanding the counts lazily'
+        for node in self.traverse():
+            yield from repeat(node.key, node.count)
+
+    def items(self):
+        'Yield (key, count) pairs in key order'
+        yield from ((node.key, node.count) for node in self.traverse())
+
+    def count(self, key):
+        node, found = self.locate(key)
+        return node.count if found else 0
+
+    def add(self, key, count=1):
+        if count < 1:
+            raise ValueError('Count must be positive: {}'.format(count))
+        node, found = self.locate(key)
+        if not found:
+            self.attach(node, AVLMultisetNode(key, count))
+            return
+
+        node.count += count
+        while node is not None:
+            node.total += count
+            node = node.parent
+
+    insert = add
+
+    def remove(self, key, count=1):
+        'Remove count occurrences of key, deleting its node at zero'
+        if count < 1:
+            raise ValueError('Count must be positive: {}'.format(count))
+        node, found = self.locate(key)
+        if not found:
+            raise KeyError('Key not found: {}'.format(key))
+        if count > node.count:
+            raise ValueError("Can't remove {} of {} occurrences of key: {}"
+                             .format(count, node.count, key))
+        if count == node.count:
+            self.delete_node(node)
+            return
+
+        node.count -= count
+        while node is not None:
+            node.total -= count
+            node = node.parent
+
+    def insert_many(self, keys, ignore_duplicates=False):
+        '''
+        Add a batch of keys. Repeats are counted, so ignore_duplicates has
+        no effect and is accepted for compatibility.
+        '''
+        for key, count in run_lengths(sorted(keys)):
+            self.add(key, count)
+
+    def retrace(self, node, delta):
+        # AVLTree.retrace, refreshing totals up to the root. A rotation
+        # moves node and a neighbour below the new subtree root, so the
+        # root's children are refreshed before the root itself.
+        while node is not None:
+            old_height = node.height
+            subtree = rebalance(node)
+            if subtree is not node:
+                for child in subtree.children:
+                    if child is not None:
+                        refresh_total(child)
+            refresh_total(subtree)
+            if node is self.root:
+                self.root = subtree
+            node = subtree.parent
+            if subtree.height == old_height:
+                break
+
+        while node is not None:
+            node.size += delta
+            refresh_total(node)
+            node = node.parent
+
+    def rank(self, key):
+        'Return the number of occurrences of keys less than key'
+        rank = 0
+        node = self.root
+        while node is not None:
+            if key > node.key:
+                rank += total(node.left) + node.count
+                node = node.right
+            elif key < node.key:
+                node = node.left
+            else:
+                rank += total(node.left)
+                break
+        return rank
+
+    def rank_many(self, keys):
+        return [self.rank(key) for key in keys]
+
+    def select_node(self, index):
+        'Return the node holding the occurrence at position index'
+        n = len(self)
+        if index < 0:
+            index += n
+        if not 0 <= index < n:
+            raise IndexError('Tree index out of range: {}'.format(index))
+
+        node = self.root
+        while True:
+            ltotal = total(node.left)
+            if index < ltotal:
+                node = node.left
+            elif index < ltotal + node.count:
+                return node
+            else:
+                index -= ltotal + node.count
+                node = node.right
+
+    def __delitem__(self, index):
+        '''
+        del tree[lo:hi] removes every occurrence of the keys in [lo, hi);
+        del tree[i] removes the single occurrence at position i
+        '''
+        if isinstance(index, slice):
+            super().__delitem__(index)
+        else:
+            self.remove(self.select_node(index).key)
+
+    def _merged(self, other, combine):
+        return merge_counts(self.items(), counted(other), combine)
+
+    def _from_pairs(self, pairs):
+        tree = AVLMultiset(hash_index=self.index is not None)
+        tree._build(pairs)
+        return tree
+
+    def union(self, other):
+        return self._from_pairs(self._merged(other, max))
+
+    def intersection(self, other):
+        return self._from_pairs(self._merged(other, min))
+
+    def difference(self, other):
+        return self._from_pairs(self._merged(other, subtract))
+
+    def symmetric_difference(self, other):
+        return self._from_pairs(self._merged(other, distance))
+
+    def issubset(self, other):
+        return next(self._merged(other, subtract), None) is None
+
+    def issuperset(self, other):
+        return next(merge_counts(counted(other), self.items(), subtract),
+                    None) is None
+
+    __or__ = union
+    __and__ = intersection
+    __sub__ = difference
+    __xor__ = symmetric_difference
+
+    def __ior__(self, other):
+        self._build(list(self._merged(other, max)))
+        return self
+
+    def __iand__(self, other):
+        self._build(list(self._merged(other, min)))
+        return self
+
+    def __isub__(self, other):
+        self._build(list(self._merged(other, subtract)))
+        return self
+
+    def __ixor__(self, other):
+        self._build(list(self._merged(other, distance)))
+        return self
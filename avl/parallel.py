@@ -0,0 +1,70 @@
+'''
+Process-parallel sorting for building very large trees.
+
+Keys are split into ranges by sampled boundaries. Worker processes sort
+each range independently, and the parent concatenates the ranges in order
+for a linear build. The build itself, which creates every node, stays in
+the parent. Keys must be picklable.
+
+Merging trees for union and intersection is not offered. Walking both
+trees and shipping every key out and back costs the parent more than the
+serial merge it would replace. Forked workers that walk the trees
+themselves fare no better, because their reference count updates force
+copies of every page of nodes they touch.
+'''
+import random
+from bisect import bisect_left
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain, repeat
+
+# Inputs with fewer keys are handled in-process
+PARALLEL_MIN = 1 << 16
+
+# Most keys sent to a worker in one task, which bounds each transfer
+TASK_SIZE = 1 << 18
+
+# Keys sampled per range when choosing range boundaries
+OVERSAMPLE = 64
+
+
+def range_count(n, workers):
+    return max(workers, -(-n // TASK_SIZE))
+
+
+def sort_keys(keys, workers):
+    '''
+    Return a list of keys in sorted order, sorting ranges of keys in that
+    many worker processes. Duplicates are kept.
+    '''
+    keys = list(keys)
+    n = len(keys)
+    if not workers or workers < 2 or n < max(PARALLEL_MIN, 1):
+        keys.sort()
+        return keys
+
+    nranges = range_count(n, workers)
+    sample = random.Random(n).sample(keys, min(n, nranges * OVERSAMPLE))
+    sample.sort()
+    splitters = sorted(set(sample[i * len(sample) // nranges]
+                           for i in range(1, nranges)))
+    chunks = [keys[i:i + TASK_SIZE] for i in range(0, n, TASK_SIZE)]
+    del keys
+
+    with ProcessPoolExecutor(workers) as pool:
+        # Each chunk comes back as one sorted run per range; then each
+        # range's runs are merged
+        partitioned = list(pool.map(partition, chunks, repeat(splitters)))
+        del chunks
+        return list(chain.from_iterable(pool.map(merge_runs,
+                                                 zip(*partitioned))))
+
+
+def partition(keys, splitters):
+    'Sort keys and cut them into runs at each splitter'
+    keys.sort()
+    cuts = [bisect_left(keys, splitter) for splitter in splitters]
+    return [keys[a:b] for a, b in zip([0] + cuts, cuts + [len(keys)])]
+
+
+def merge_runs(runs):
+    return sorted(chain.from_iterable(runs))
@@ -0,0 +1,248 @@
+'''
+A persistent AVL tree. Nodes are never changed once built: an update
+copies the O(log n) nodes on the path to the key and shares every other
+subtree with the version it came from. Nodes have no parent pointers,
+which would tie each node to a single version.
+'''
+from .avl import (bound, height, leftmost, rank_under, rightmost, search,
+                  select_under)
+
+
+class PersistentNode(object):
+
+    'An immutable node, possibly shared by many versions of a tree'
+    __slots__ = ['key', 'left', 'right', 'height', 'size']
+
+    def __init__(self, key, left=None, right=None):
+        self.key = key
+        self.left = left
+        self.right = right
+        lheight, lsize = (left.height, left.size) if left is not None else (0, 0)
+        rheight, rsize = (right.height, right.size) if right is not None else (0, 0)
+        self.height = max(lheight, rheight) + 1
+        self.size = lsize + rsize + 1
+
+    def __repr__(self):
+        return 'PersistentNode({})'.format(self.key)
+
+    @property
+    def children(self):
+        return self.left, self.right
+
+
+def balanced(key, left, right):
+    '''
+    Return a new node for key over left and right, rotating if their
+    heights differ by two
+    '''
+    lheight, rheight = height(left), height(right)
+    if lheight > rheight + 1:
+        if height(left.left) >= height(left.right):
+            return PersistentNode(left.key, left.left,
+                                  PersistentNode(key, left.right, right))
+        pivot = left.right
+        return PersistentNode(pivot.key,
+                              PersistentNode(left.key, left.left, pivot.left),
+                              PersistentNode(key, pivot.right, right))
+
+    elif rheight > lheight + 1:
+        if height(right.right) >= height(right.left):
+            return PersistentNode(right.key,
+                                  PersistentNode(key, left, right.left),
+                                  right.right)
+        pivot = right.left
+        return PersistentNode(pivot.key,
+                              PersistentNode(key, left, pivot.left),
+                              PersistentNode(right.key, pivot.right,
+                                             right.right))
+
+    return PersistentNode(key, left, right)
+
+
+def inserted(node, key):
+    'Return a copy of the subtree at node with key added'
+    if node is None:
+        return PersistentNode(key)
+    elif key < node.key:
+        return balanced(node.key, inserted(node.left, key), node.right)
+    elif key > node.key:
+        return balanced(node.key, node.left, inserted(node.right, key))
+    raise ValueError("Can't add node for key: {}".format(key))
+
+
+def deleted(node, key):
+    'Return a copy of the subtree at node with key removed'
+    if node is None:
+        raise KeyError('Key not found: {}'.format(key))
+    elif key < node.key:
+        return balanced(node.key, deleted(node.left, key), node.right)
+    elif key > node.key:
+        return balanced(node.key, node.left, deleted(node.right, key))
+
+    if node.left is None:
+        return node.right
+    elif node.right is None:
+        return node.left
+    successor, right = popped_min(node.right)
+    return balanced(successor, node.left, right)
+
+
+def popped_min(node):
+    'Return the smallest key under node and a copy of the rest'
+    if node.left is None:
+        return node.key, node.right
+    key, left = popped_min(node.left)
+    return key, balanced(node.key, left, node.right)
+
+
+def build(keys, lo, hi):
+    if lo >= hi:
+        return None
+    mid = (lo + hi) // 2
+    return PersistentNode(keys[mid], build(keys, lo, mid),
+                          build(keys, mid + 1, hi))
+
+
+class PersistentAVLTree(object):
+
+    '''
+    An immutable sorted set of keys. insert and delete leave the tree
+    as it is and return a new version, which allocates O(log n) nodes and
+    shares the rest. Versions can be read from any thread without locks.
+    '''
+
+    def __init__(self, root=None):
+        self.root = root
+
+    @classmethod
+    def from_keys(cls, keys):
+        return cls.from_sorted(sorted(keys))
+
+    @classmethod
+    def from_sorted(cls, keys):
+        'Build a balanced tree in linear time from strictly increasing keys'
+        keys = list(keys)
+        for a, b in zip(keys, keys[1:]):
+            if not a < b:
+                raise ValueError("Can't add node for key: {}".format(b))
+        return cls(build(keys, 0, len(keys)))
+
+    def snapshot(self):
+        'Versions never change, so a snapshot is the version itself'
+        return self
+
+    def insert(self, key):
+        return PersistentAVLTree(inserted(self.root, key))
+
+    def delete(self, key):
+        return PersistentAVLTree(deleted(self.root, key))
+
+    def __contains__(self, key):
+        return search(self.root, key) is not None
+
+    def __len__(self):
+        return self.root.size if self.root is not None else 0
+
+    def __iter__(self):
+        return self.keys()
+
+    def __getitem__(self, index):
+        return self.select(index)
+
+    def size(self):
+        return len(self)
+
+    def keys(self):
+        stack = []
+        node = self.root
+        while stack or node is not None:
+            if node is not None:
+                stack.append(node)
+                node = node.left
+            else:
+                node = stack.pop()
+                yield node.key
+                node = node.right
+
+    elements = keys
+
+    def contains_key(self, key):
+        return key in self
+
+    def irange(self, lo=None, hi=None, inclusive=(True, False), reverse=False):
+        lo_inclusive, hi_inclusive = inclusive
+
+        def above_lo(key):
+            return lo is None or key > lo or (lo_inclusive and key == lo)
+
+        def below_hi(key):
+            return hi is None or key < hi or (hi_inclusive and key == hi)
+
+        if reverse:
+            within_start, within_end = below_hi, above_lo
+            first, second = 'right', 'left'
+        else:
+            within_start, within_end = above_lo, below_hi
+            first, second = 'left', 'right'
+
+        # Stack the path to the first key in range, then walk in order
+        stack = []
+        node = self.root
+        while node is not None:
+            if within_start(node.key):
+                stack.append(node)
+                node = getattr(node, first)
+            else:
+                node = getattr(node, second)
+
+        while stack:
+            node = stack.pop()
+            if not within_end(node.key):
+                return
+            yield node.key
+
+            node = getattr(node, second)
+            while node is not None:
+                stack.append(node)
+                node = getattr(node, first)
+
+    def min(self):
+        if self.root is None:
+            raise KeyError('Tree empty!')
+        return leftmost(self.root).key
+
+    def max(self):
+        if self.root is None:
+            raise KeyError('Tree empty!')
+        return rightmost(self.root).key
+
+    def rank(self, key):
+        'Return the number of keys in the tree less than key'
+        return rank_under(self.root, key)
+
+    def select(self, index):
+        n = len(self)
+        if index < 0:
+            index += n
+        if not 0 <= index < n:
+            raise IndexError('Tree index out of range: {}'.format(index))
+        return select_under(self.root, index).key
+
+    def _bound(self, key, below, inclusive):
+        node = bound(self.root, key, below, inclusive)
+        if node is None:
+            raise KeyError('No key {} {}'.format('below' if below else 'above',
+                                                 key))
+        return node.key
+
+    def floor(self, key):
+        return self._bound(key, below=True, inclusive=True)
+
+    def ceiling(self, key):
+        return self._bound(key, below=False, inclusive=True)
+
+    def predecessor(self, key):
+        return self._bound(key, below=True, inclusive=False)
+
+    def successor(self, key):
+        return self._bound(key, below=False, inclusive=False)
@@ -0,0 +1,413 @@
+'''
+A tree whose key space is split into contiguous ranges, each held by an
+AVLTree in its own worker process. Point operations are routed to the
+one shard owning the key; batch queries are sent to every shard involved
+before any reply is read, so the shards work on them concurrently. Range
+scans stream keys from one shard at a time, a bounded chunk per request.
+'''
+import multiprocessing
+from bisect import bisect_right
+from itertools import islice
+
+from .avl import AVLTree, merge_sorted, search_is_cheaper
+
+# Shards are rebalanced once the largest holds more than SKEW_FACTOR times
+# its fair share of the keys, counting at least MIN_SHARD_SIZE keys as a
+# fair share so small trees are left alone
+SKEW_FACTOR = 2
+MIN_SHARD_SIZE = 4096
+
+# Keys fetched per request while streaming a range scan, which bounds the
+# keys held in the parent and shipped past an early exit
+STREAM_CHUNK = 4096
+
+
+def serve(conn):
+    '''
+    Worker process loop: apply (method, args) requests to a private tree
+    and send back (ok, result) pairs. Range scans send back at most limit
+    keys as a list.
+    '''
+    tree = AVLTree()
+    while True:
+        name, args = conn.recv()
+        if name == 'close':
+            conn.close()
+            return
+
+        try:
+            if name == 'load':
+                tree = AVLTree.from_sorted(*args)
+                result = None
+            elif name == 'irange':
+                *args, limit = args
+                result = list(islice(tree.irange(*args), limit))
+            else:
+                result = getattr(tree, name)(*args)
+        except Exception as e:
+            conn.send((False, e))
+        else:
+            conn.send((True, result))
+
+
+class ShardedAVLTree(object):
+
+    '''
+    An ordered set of keys spread over range shards in worker processes.
+    Keys must be picklable. Call close, or use the tree as a context
+    manager, to stop the workers.
+
+    Set algebra merges the key streams of both operands, which may be
+    ShardedAVLTrees or trees without a key function. union, intersection,
+    difference and symmetric_difference return a new ShardedAVLTree with
+    as many shards, and its own workers to close.
+    '''
+
+    def __init__(self, shards=4):
+        ctx = multiprocessing.get_context()
+        self._conns = []
+        self._procs = []
+        for _ in range(shards):
+            parent, child = ctx.Pipe()
+            proc = ctx.Process(target=serve, args=(child,), daemon=True)
+            proc.start()
+            child.close()
+            self._conns.append(parent)
+            self._procs.append(proc)
+
+        # Shard i holds the keys k with bounds[i - 1] <= k < bounds[i]
+        self._bounds = []
+        self._sizes = [0] * shards
+
+    @classmethod
+    def from_keys(cls, keys, shards=4):
+        tree = cls(shards)
+        tree._load(sorted(keys))
+        return tree
+
+    def close(self):
+        for conn in self._conns:
+            conn.send(('close', ()))
+            conn.close()
+        for proc in self._procs:
+            proc.join()
+        self._conns = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # Messaging
+
+    def _call(self, shard, name, *args):
+        return self._fanout([(shard, name, args)])[0]
+
+    def _fanout(self, calls):
+        'Send every (shard, name, args) call, then collect the results'
+        sent = []
+        try:
+            for shard, name, args in calls:
+                self._conns[shard].send((name, args))
+                sent.append(shard)
+        finally:
+            # Read every reply owed, even when a later send failed, so no
+            # pipe is left holding a stale reply for the next call
+            replies = [self._conns[shard].recv() for shard in sent]
+
+        for ok, result in replies:
+            if not ok:
+                raise result
+        return [result for _, result in replies]
+
+    def _all(self, name, *args):
+        return self._fanout([(i, name, args) for i in range(len(self._conns))])
+
+    def _shard(self, key):
+        return bisect_right(self._bounds, key)
+
+    def _group(self, keys):
+        'Map each shard to the positions of the keys it owns'
+        groups = {}
+        for i, key in enumerate(keys):
+            groups.setdefault(self._shard(key), []).append(i)
+        return groups
+
+    # Shard boundaries
+
+    def _load(self, keys):
+        'Spread strictly increasing keys evenly over the shards'
+        n, count = len(keys), len(self._conns)
+        if n < count:
+            self._bounds = []
+            cuts = [0] + [n] * count
+        else:
+            cuts = [i * n // count for i in range(count + 1)]
+            self._bounds = [keys[cut] for cut in cuts[1:-1]]
+        self._fanout([(i, 'load', (keys[cuts[i]:cuts[i + 1]],))
+                      for i in range(count)])
+        self._sizes = [cuts[i + 1] - cuts[i] for i in range(count)]
+
+    def is_skewed(self):
+        fair = max(len(self) / len(self._conns), MIN_SHARD_SIZE)
+        return max(self._sizes) > SKEW_FACTOR * fair
+
+    def rebalance(self):
+        'Move the shard boundaries so every shard holds an equal share'
+        self._load(list(self.keys()))
+
+    def _resized(self):
+        self._sizes = self._all('__len__')
+        if self.is_skewed():
+            self.rebalance()
+
+    # Queries
+
+    def __contains__(self, key):
+        return self._call(self._shard(key), '__contains__', key)
+
+    def __len__(self):
+        return sum(self._sizes)
+
+    def __iter__(self):
+        return self.keys()
+
+    def __getitem__(self, index):
+        return self.select(index)
+
+    def size(self):
+        return len(self)
+
+    def shard_sizes(self):
+        return list(self._sizes)
+
+    def keys(self):
+        return self.irange()
+
+    elements = keys
+
+    def contains_key(self, key):
+        return key in self
+
+    def contains_many(self, keys):
+        'Return a list of which keys are in the tree'
+        keys = list(keys)
+        groups = self._group(keys)
+        shards = list(groups)
+        answers = self._fanout([(shard, 'contains_many',
+                                 ([keys[i] for i in groups[shard]],))
+                                for shard in shards])
+
+        found = [False] * len(keys)
+        for shard, answer in zip(shards, answers):
+            for i, hit in zip(groups[shard], answer):
+                found[i] = hit
+        return found
+
+    def irange(self, lo=None, hi=None, inclusive=(True, False), reverse=False):
+        '''
+        Stream the keys in a range, STREAM_CHUNK keys per request. Each
+        chunk resumes after the last key read, so the tree may change (and
+        its shards be rebalanced) while the iterator is suspended.
+        '''
+        lo_inclusive, hi_inclusive = inclusive
+        while True:
+            first = self._shard(lo) if lo is not None else 0
+            last = self._shard(hi) if hi is not None else len(self._conns) - 1
+            shards = self._nonempty(range(first, last + 1))
+            if reverse:
+                shards.reverse()
+
+            chunk = []
+            for shard in shards:
+                chunk = self._call(shard, 'irange',
+                                   lo, hi, (lo_inclusive, hi_inclusive),
+                                   reverse, STREAM_CHUNK)
+                if chunk:
+                    break
+            if not chunk:
+                return
+            yield from chunk
+            if reverse:
+                hi, hi_inclusive = chunk[-1], False
+            else:
+                lo, lo_inclusive = chunk[-1], False
+
+    def _nonempty(self, shards):
+        return [i for i in shards if self._sizes[i]]
+
+    def min(self):
+        shards = self._nonempty(range(len(self._conns)))
+        if not shards:
+            raise KeyError('Tree empty!')
+        return self._call(shards[0], 'min')
+
+    def max(self):
+        shards = self._nonempty(range(len(self._conns)))
+        if not shards:
+            raise KeyError('Tree empty!')
+        return self._call(shards[-1], 'max')
+
+    def _bound(self, name, key, below):
+        # Ask the owning shard, then fall back to the nearest non-empty
+        # shard on the side the bound lies
+        shard = self._shard(key)
+        try:
+            return self._call(shard, name, key)
+        except KeyError:
+            pass
+
+        if below:
+            shards = self._nonempty(range(shard))
+            if shards:
+                return self._call(shards[-1], 'max')
+        else:
+            shards = self._nonempty(range(shard + 1, len(self._conns)))
+            if shards:
+                return self._call(shards[0], 'min')
+        raise KeyError('No key {} {}'.format('below' if below else 'above',
+                                             key))
+
+    def floor(self, key):
+        return self._bound('floor', key, True)
+
+    def ceiling(self, key):
+        return self._bound('ceiling', key, False)
+
+    def predecessor(self, key):
+        return self._bound('predecessor', key, True)
+
+    def successor(self, key):
+        return self._bound('successor', key, False)
+
+    def rank(self, key):
+        shard = self._shard(key)
+        return sum(self._sizes[:shard]) + self._call(shard, 'rank', key)
+
+    def select(self, index):
+        n = len(self)
+        if index < 0:
+            index += n
+        if not 0 <= index < n:
+            raise IndexError('Tree index out of range: {}'.format(index))
+
+        for shard, size in enumerate(self._sizes):
+            if index < size:
+                return self._call(shard, 'select', index)
+            index -= size
+
+    # Mutation
+
+    def insert(self, key):
+        shard = self._shard(key)
+        self._call(shard, 'insert', key)
+        self._sizes[shard] += 1
+        if self.is_skewed():
+            self.rebalance()
+
+    def delete(self, key):
+        shard = self._shard(key)
+        self._call(shard, 'delete', key)
+        self._sizes[shard] -= 1
+        if self.is_skewed():
+            self.rebalance()
+
+    def insert_many(self, keys, ignore_duplicates=False):
+        '''
+        Insert a batch of keys, each shard inserting its share in parallel.
+        Unless ignore_duplicates is set, duplicates raise ValueError before
+        any shard is changed.
+        '''
+        keys = list(keys)
+        if not ignore_duplicates:
+            if len(set(keys)) < len(keys) or any(self.contains_many(keys)):
+                raise ValueError("Can't add duplicate keys")
+
+        groups = self._group(keys)
+        self._fanout([(shard, 'insert_many',
+                       ([keys[i] for i in positions], True))
+                      for shard, positions in groups.items()])
+        self._resized()
+
+    def delete_many(self, keys, ignore_missing=False):
+        '''
+        Delete a batch of keys, each shard deleting its share in parallel.
+        Unless ignore_missing is set, missing or repeated keys raise
+        KeyError before any shard is changed.
+        '''
+        keys = list(keys)
+        if not ignore_missing:
+            if len(set(keys)) < len(keys) or not all(self.contains_many(keys)):
+                raise KeyError('Keys not found')
+
+        groups = self._group(keys)
+        self._fanout([(shard, 'delete_many',
+                       ([keys[i] for i in positions], True))
+                      for shard, positions in groups.items()])
+        self._resized()
+
+    # Set algebra
+
+    def _check_keys(self, other):
+        if getattr(other, 'keyfunc', None) is not None:
+            raise TypeError("Can't combine with a tree with a key function")
+
+    def _merged(self, other, left, both, right):
+        self._check_keys(other)
+        return merge_sorted(self.keys(), other.keys(), left, both, right)
+
+    def _from_sorted(self, keys):
+        tree = ShardedAVLTree(len(self._conns))
+        tree._load(list(keys))
+        return tree
+
+    def union(self, other):
+        return self._from_sorted(self._merged(other, True, True, True))
+
+    def intersection(self, other):
+        return self._from_sorted(self._merged(other, False, True, False))
+
+    def difference(self, other):
+        return self._from_sorted(self._merged(other, True, False, False))
+
+    def symmetric_difference(self, other):
+        return self._from_sorted(self._merged(other, True, False, True))
+
+    def issubset(self, other):
+        if len(self) > len(other):
+            return False
+        return next(self._merged(other, True, False, False), None) is None
+
+    def issuperset(self, other):
+        if len(other) > len(self):
+            return False
+        if search_is_cheaper(len(other), len(self)):
+            return all(self.contains_many(other.keys()))
+        return next(self._merged(other, False, False, True), None) is None
+
+    def isdisjoint(self, other):
+        return next(self._merged(other, False, True, False), None) is None
+
+    __or__ = union
+    __and__ = intersection
+    __sub__ = difference
+    __xor__ = symmetric_difference
+
+    def __ior__(self, other):
+        self._check_keys(other)
+        self.insert_many(other.keys(), ignore_duplicates=True)
+        return self
+
+    def __iand__(self, other):
+        self._load(list(self._merged(other, False, True, False)))
+        return self
+
+    def __isub__(self, other):
+        self._check_keys(other)
+        self.delete_many(other.keys(), ignore_missing=True)
+        return self
+
+    def __ixor__(self, other):
+        self._load(list(self._merged(other, True, False, True)))
+        return self
@@ -0,0 +1,150 @@
+import pickle
+import struct
+import sys
+from array import array
+from itertools import islice
+
+# A snapshot is a header followed by frames of consecutive keys in sorted
+# order, ending with an empty end frame. Each frame starts with its kind,
+# its item count and its payload size. Runs of ints, floats and bytes are
+# stored as packed little-endian columns; anything else is pickled. Trees
+# that carry values follow each key frame with a pickled frame of values.
+
+MAGIC = b'AVLS'
+VERSION = 1
+HAS_VALUES = 1
+
+HEADER = struct.Struct('<4sBB')
+FRAME = struct.Struct('<cIQ')
+
+INT_FRAME = b'i'
+FLOAT_FRAME = b'f'
+BYTES_FRAME = b'y'
+PICKLE_FRAME = b'p'
+END_FRAME = b'E'
+
+CHUNK_SIZE = 65536
+
+
+def _packed(typecode, items):
+    column = array(typecode, items)
+    if sys.byteorder == 'big':
+        column.byteswap()
+    return column.tobytes()
+
+
+def _unpacked(typecode, payload):
+    column = array(typecode)
+    column.frombytes(payload)
+    if sys.byteorder == 'big':
+        column.byteswap()
+    return column
+
+
+def encode_chunk(items):
+    'Return the frame kind and payload for a list of keys'
+    kinds = {type(item) for item in items}
+    if kinds == {int}:
+        try:
+            return INT_FRAME, _packed('q', items)
+        except OverflowError:
+            pass
+    elif kinds == {float}:
+        return FLOAT_FRAME, _packed('d', items)
+    elif kinds == {bytes}:
+        return BYTES_FRAME, (_packed('I', [len(item) for item in items]) +
+                             b''.join(items))
+
+    return PICKLE_FRAME, pickle.dumps(items, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def decode_chunk(kind, count, payload):
+    if kind == INT_FRAME:
+        return _unpacked('q', payload)
+    elif kind == FLOAT_FRAME:
+        return _unpacked('d', payload)
+    elif kind == BYTES_FRAME:
+        lengths = _unpacked('I', payload[:4 * count])
+        data = memoryview(payload)[4 * count:]
+        items, offset = [], 0
+        for length in lengths:
+            items.append(bytes(data[offset:offset + length]))
+            offset += length
+        return items
+    elif kind == PICKLE_FRAME:
+        return pickle.loads(payload)
+    raise ValueError('Unknown snapshot frame: {!r}'.format(kind))
+
+
+def _write_frame(fileobj, kind, count, payload):
+    fileobj.write(FRAME.pack(kind, count, len(payload)))
+    fileobj.write(payload)
+
+
+def _read_frame(fileobj):
+    header = fileobj.read(FRAME.size)
+    if len(header) < FRAME.size:
+        raise ValueError('Truncated snapshot')
+    kind, count, size = FRAME.unpack(header)
+    payload = fileobj.read(size)
+    if len(payload) < size:
+        raise ValueError('Truncated snapshot')
+    return kind, count, payload
+
+
+def write_snapshot(fileobj, keys, values=None):
+    '''
+    Write sorted keys, and optionally their values, to a binary file
+    object in chunks, without materializing the whole sequence
+    '''
+    fileobj.write(HEADER.pack(MAGIC, VERSION,
+                              HAS_VALUES if values is not None else 0))
+    keys = iter(keys)
+    values = iter(values) if values is not None else None
+
+    while True:
+        chunk = list(islice(keys, CHUNK_SIZE))
+        if not chunk:
+            break
+        kind, payload = encode_chunk(chunk)
+        _write_frame(fileobj, kind, len(chunk), payload)
+        if values is not None:
+            vchunk = list(islice(values, len(chunk)))
+            _write_frame(fileobj, PICKLE_FRAME, len(vchunk),
+                         pickle.dumps(vchunk, protocol=pickle.HIGHEST_PROTOCOL))
+
+    _write_frame(fileobj, END_FRAME, 0, b'')
+
+
+def read_snapshot(fileobj, values=False):
+    '''
+    Lazily yield the keys stored in a snapshot in order, or (key, value)
+    pairs when values is set. Values missing from the snapshot read as
+    None.
+    '''
+    header = fileobj.read(HEADER.size)
+    if len(header) < HEADER.size:
+        raise ValueError('Truncated snapshot')
+    magic, version, flags = HEADER.unpack(header)
+    if magic != MAGIC:
+        raise ValueError('Not an AVL snapshot')
+    if version != VERSION:
+        raise ValueError('Unsupported snapshot version: {}'.format(version))
+    has_values = flags & HAS_VALUES
+
+    while True:
+        kind, count, payload = _read_frame(fileobj)
+        if kind == END_FRAME:
+            return
+        keys = decode_chunk(kind, count, payload)
+
+        if has_values:
+            vkind, vcount, vpayload = _read_frame(fileobj)
+            chunk_values = decode_chunk(vkind, vcount, vpayload)
+        else:
+            chunk_values = [None] * count
+
+        if values:
+            yield from zip(keys, chunk_values)
+        else:
+            yield from keys
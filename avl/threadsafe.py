@@ -0,0 +1,161 @@
+'''
+A thread-safe wrapper around AVLTree. Queries take a shared read lock and
+run in parallel with each other; updates take an exclusive write lock.
+'''
+import threading
+from contextlib import contextmanager
+from itertools import islice
+
+from .avl import AVLTree
+
+# Keys an iterator collects per turn of the read lock
+ITER_CHUNK = 256
+
+
+class RWLock(object):
+
+    '''
+    A readers-writer lock. Any number of readers may hold it at once, or
+    a single writer. Waiting writers block new readers so they cannot
+    starve. Not reentrant.
+    '''
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writing = False
+        self._writers_waiting = 0
+
+    @contextmanager
+    def read(self):
+        with self._cond:
+            while self._writing or self._writers_waiting:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if not self._readers:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def write(self):
+        with self._cond:
+            self._writers_waiting += 1
+            while self._writing or self._readers:
+                self._cond.wait()
+            self._writers_waiting -= 1
+            self._writing = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writing = False
+                self._cond.notify_all()
+
+
+def _reader(name):
+    def method(self, *args, **kwargs):
+        with self.lock.read():
+            return getattr(self.tree, name)(*args, **kwargs)
+    method.__name__ = name
+    return method
+
+
+def _writer(name):
+    def method(self, *args, **kwargs):
+        with self.lock.write():
+            result = getattr(self.tree, name)(*args, **kwargs)
+            # A write that raised left the tree as it was, so iterators
+            # stay valid
+            self.version += 1
+            return result
+    method.__name__ = name
+    return method
+
+
+def _iterator(name):
+    def method(self, *args, **kwargs):
+        return self._guarded(getattr(self.tree, name)(*args, **kwargs))
+    method.__name__ = name
+    return method
+
+
+class ConcurrentAVLTree(object):
+
+    '''
+    An AVLTree shared between threads. Iterators advance a chunk of keys
+    at a time under the read lock, and raise RuntimeError if the tree was
+    changed since they started; snapshot returns a consistent copy to
+    iterate instead. Nodes returned by find_node must not be used after
+    the tree changes.
+    '''
+
+    def __init__(self, tree=None):
+        self.tree = tree if tree is not None else AVLTree()
+        self.lock = RWLock()
+        self.version = 0
+
+    @classmethod
+    def from_keys(cls, keys, **kwargs):
+        return cls(AVLTree.from_keys(keys, **kwargs))
+
+    def snapshot(self):
+        'Return an AVLTree copy of the current keys, taken under the read lock'
+        with self.lock.read():
+            tree = self.tree
+            if tree.keyfunc is not None:
+                return AVLTree.from_sorted(tree.elements(), key=tree.keyfunc)
+            return AVLTree.from_sorted(tree.keys())
+
+    def _guarded(self, iterator):
+        # The version is taken under the lock with the first chunk, so a
+        # write finishing before the iterator starts doesn't count
+        version = None
+        while True:
+            with self.lock.read():
+                if version is None:
+                    version = self.version
+                elif self.version != version:
+                    raise RuntimeError('Tree changed during iteration')
+                chunk = list(islice(iterator, ITER_CHUNK))
+            yield from chunk
+            if len(chunk) < ITER_CHUNK:
+                return
+
+    def __iter__(self):
+        return self.elements()
+
+    __contains__ = _reader('__contains__')
+    __len__ = _reader('__len__')
+    __getitem__ = _reader('__getitem__')
+    size = _reader('size')
+    contains_key = _reader('contains_key')
+    contains_many = _reader('contains_many')
+    find_node = _reader('find_node')
+    rank = _reader('rank')
+    rank_many = _reader('rank_many')
+    select = _reader('select')
+    min = _reader('min')
+    max = _reader('max')
+    floor = _reader('floor')
+    ceiling = _reader('ceiling')
+    predecessor = _reader('predecessor')
+    successor = _reader('successor')
+    floor_many = _reader('floor_many')
+    ceiling_many = _reader('ceiling_many')
+    issubset = _reader('issubset')
+    issuperset = _reader('issuperset')
+    isdisjoint = _reader('isdisjoint')
+
+    keys = _iterator('keys')
+    elements = _iterator('elements')
+    irange = _iterator('irange')
+
+    insert = _writer('insert')
+    delete = _writer('delete')
+    insert_many = _writer('insert_many')
+    delete_many = _writer('delete_many')
+    __delitem__ = _writer('__delitem__')
@@ -4,4 +4,5 @@ from setuptools import setup
 setup(name='avl',
       version='0.1', 
       description='A python AVL Tree implementation',
-      author='James Hicks')
+      author='James Hicks',
+      extras_require={'numpy': ['numpy']})
@@ -0,0 +1,122 @@
+import asyncio
+import random
+from concurrent.futures import ThreadPoolExecutor
+
+from nose.tools import assert_raises
+from avl import AVLTree
+
+from testavl import check_tree
+
+
+async def with_ticker(operation):
+    'Await operation, counting the times other tasks got to run meanwhile'
+    ticks = 0
+
+    async def tick():
+        nonlocal ticks
+        while True:
+            ticks += 1
+            await asyncio.sleep(0)
+
+    ticker = asyncio.ensure_future(tick())
+    await asyncio.sleep(0)
+    start = ticks
+    try:
+        result = await operation
+    finally:
+        ticker.cancel()
+    return result, ticks - start
+
+
+def test_build():
+    rng = random.Random(23)
+    keys = rng.sample(range(100000), 5000)
+    others = rng.sample(range(100000), 5000)
+
+    async def run():
+        tree, ticks = await with_ticker(AVLTree.afrom_keys(keys, budget=100))
+        assert ticks >= 50
+        check_tree(tree)
+        assert list(tree.keys()) == sorted(keys)
+
+        with ThreadPoolExecutor(1) as executor:
+            indexed = await AVLTree.afrom_keys(keys, hash_index=True,
+                                               executor=executor)
+        check_tree(indexed)
+        assert list(indexed.keys()) == sorted(keys)
+
+        other = AVLTree.from_keys(others)
+        union, ticks = await with_ticker(tree.aunion(other, budget=100))
+        assert ticks >= 50
+        check_tree(union)
+        assert list(union.keys()) == sorted(set(keys) | set(others))
+        check_tree(await indexed.aunion(other))
+
+        _, ticks = await with_ticker(tree.ainsert_many(others, True, 100))
+        assert ticks >= 50
+        check_tree(tree)
+        assert list(tree.keys()) == list(union.keys())
+
+        # Batches before the duplicate stay in
+        try:
+            await tree.ainsert_many([-2, -1, 0, keys[0]], budget=2)
+        except ValueError:
+            pass
+        else:
+            assert False, 'duplicate not detected'
+        assert -2 in tree and -1 in tree and 0 not in tree
+
+        empty = await AVLTree.afrom_keys([])
+        assert len(empty) == 0 and empty.root is None
+        keyed = AVLTree(key=abs)
+        try:
+            await keyed.aunion(tree)
+        except TypeError:
+            pass
+        else:
+            assert False, 'keyed union not rejected'
+
+    asyncio.run(run())
+    assert_raises(ValueError, asyncio.run, AVLTree.afrom_keys([1, 2, 1]))
+
+
+def test_iteration():
+    tree = AVLTree.from_keys(range(0, 3000, 2))
+
+    async def collect(keys):
+        return [key async for key in keys]
+
+    async def run():
+        assert await collect(tree.aiter_keys(budget=7)) == list(tree.keys())
+        for lo, hi, inclusive in [(10, 500, (True, False)),
+                                  (9, 501, (False, True)),
+                                  (None, 40, (True, True)),
+                                  (2990, None, (False, False))]:
+            for reverse in (False, True):
+                assert (await collect(tree.airange(lo, hi, inclusive, reverse,
+                                                   budget=5)) ==
+                        list(tree.irange(lo, hi, inclusive, reverse)))
+
+        async def mutate():
+            # Add and remove odd keys at every turn the iterator gives up
+            rng = random.Random(23)
+            odd = set()
+            for _ in range(500):
+                key = rng.randrange(1500) * 2 + 1
+                if key in odd:
+                    tree.delete(key)
+                    odd.remove(key)
+                else:
+                    tree.insert(key)
+                    odd.add(key)
+                await asyncio.sleep(0)
+
+        # Every even key stays put, so each is seen exactly once
+        seen, _ = await asyncio.gather(collect(tree.aiter_keys(budget=10)),
+                                       mutate())
+        assert seen == sorted(set(seen))
+        assert [key for key in seen if key % 2 == 0] == list(range(0, 3000, 2))
+        assert any(key % 2 for key in seen)
+        check_tree(tree)
+
+    asyncio.run(run())
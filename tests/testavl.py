@@ -1,8 +1,84 @@
+import io
+import pickle
+import random
+
 from nose.tools import assert_raises
-from avl import AVLNode, AVLTree, Stack
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from avl import AVLNode, AVLTree, AVLMap, Stack, next_node, prev_node
+from avl import FrozenAVLTree
 from avl import rotate_right, rotate_left
 from avl import rotate_double_left, rotate_double_right
 
+
+def insert_keys(keys):
+    # Build a tree by repeated insertion, so its shape follows insert order
+    tree = AVLTree()
+    for key in keys:
+        tree.insert(key)
+    return tree
+
+def check_tree(tree):
+    # Verify balance, ordering, parent links and stored heights
+    def check(node):
+        if node is None:
+            return 0
+        lh, rh = check(node.left), check(node.right)
+        assert node.verify()
+        assert node.height == max(lh, rh) + 1
+        assert node.size == sum(c.size for c in node.children
+                                if c is not None) + 1
+        for child in node.children:
+            if child is not None:
+                assert child.parent is node
+        return node.height
+
+    if tree.root is not None:
+        assert tree.root.parent is None
+    check(tree.root)
+
+    if tree.index is not None:
+        nodes = list(tree.traverse())
+        assert len(tree.index) == len(nodes)
+        assert all(tree.index[node.key] is node for node in nodes)
+
+
+def check_same(other, tree, probes):
+    # Compare the queries of another sorted-set implementation with an
+    # AVLTree holding the same keys
+    assert len(other) == len(tree)
+    assert list(other.keys()) == list(tree.keys())
+    assert list(other) == list(tree)
+    if len(tree):
+        assert other.min() == tree.min() and other.max() == tree.max()
+    else:
+        assert_raises(KeyError, other.min)
+
+    for probe in probes:
+        assert (probe in other) == (probe in tree)
+        assert other.rank(probe) == tree.rank(probe)
+        for name in ('floor', 'ceiling', 'predecessor', 'successor'):
+            try:
+                expected = getattr(tree, name)(probe)
+            except KeyError:
+                assert_raises(KeyError, getattr(other, name), probe)
+            else:
+                assert getattr(other, name)(probe) == expected
+
+    for i in range(-len(tree), len(tree)):
+        assert other[i] == tree[i]
+    assert_raises(IndexError, other.select, len(tree))
+
+    for lo, hi in [(None, None), (10, 50), (11, 49), (50, 10), (None, 7),
+                   (50, 150)]:
+        for inclusive in [(True, False), (False, True), (True, True)]:
+            for reverse in (False, True):
+                assert (list(other.irange(lo, hi, inclusive, reverse)) ==
+                        list(tree.irange(lo, hi, inclusive, reverse)))
+
 def test_stack():
     s = Stack([1,2,3,4])
     assert bool(s)
@@ -262,7 +338,7 @@ def test_insertion():
     assert tree.root.left.right.key == 7
 
 def test_path():
-    tree = AVLTree.from_keys([69, 60, 22, 91, 19, 71, 96, 27, 84, 43])
+    tree = insert_keys([69, 60, 22, 91, 19, 71, 96, 27, 84, 43])
     assert tree.root.key == 60
 
     expected = [84,91,71,60]
@@ -281,6 +357,55 @@ def test_traverse():
 
 
 
+def test_stepping():
+    keys = [10, 5, 3, 18, 2, 7, 30, 25]
+    tree = insert_keys(keys)
+    nodes = list(tree.traverse())
+    for a, b in zip(nodes, nodes[1:]):
+        assert next_node(a) is b and prev_node(b) is a
+    assert next_node(nodes[-1]) is None and prev_node(nodes[0]) is None
+    assert list(AVLTree().traverse()) == [] and list(AVLTree().keys()) == []
+
+    # Iteration allocates no per-node stack items
+    import avl.avl
+    class NoStack(object):
+        def __init__(self, *args, **kwargs):
+            raise AssertionError('StackItem allocated')
+    saved, avl.avl.StackItem = avl.avl.StackItem, NoStack
+    try:
+        assert list(tree.keys()) == sorted(keys)
+        assert list(tree.irange(4, 20)) == [5, 7, 10, 18]
+    finally:
+        avl.avl.StackItem = saved
+
+def test_cursor():
+    tree = AVLTree.from_keys(range(0, 50, 5))
+    c = tree.cursor()
+    assert c.key == 0
+    assert_raises(KeyError, c.prev)
+    assert c.key == 0
+    assert [c.next() for _ in range(3)] == [5, 10, 15]
+    assert c.prev() == 10
+
+    assert c.seek(25) and c.key == 25
+    assert not c.seek(26) and c.key == 30
+    assert c.next() == 35 and c.next() == 40 and c.next() == 45
+    assert_raises(KeyError, c.next)
+    assert c.key == 45
+
+    assert not c.seek(46) and not c
+    assert_raises(KeyError, lambda: c.key)
+    assert_raises(KeyError, c.next)
+
+    c = tree.cursor(12)
+    assert c.key == 15
+    # The cursor survives changes elsewhere in the tree
+    tree.insert(16)
+    tree.delete(20)
+    assert c.next() == 16 and c.next() == 25
+
+    assert not AVLTree().cursor()
+
 def test_minmax():
     tree = AVLTree()
 
@@ -299,7 +424,7 @@ def test_del():
 
 
     # Delete leaf
-    tree = AVLTree.from_keys([10,5,25,3,8])
+    tree = insert_keys([10,5,25,3,8])
     assert tree.size() == 5
     assert tree.root.key == 10
     assert tree.root.left.key, tree.root.right.key == (5,25)
@@ -314,18 +439,18 @@ def test_del():
     assert 8 not in {x.key for x in tree.traverse()}
 
     # Delete node with one child
-    tree = AVLTree.from_keys(rvals)
+    tree = insert_keys(rvals)
     tree.delete(64)
     assert tree.root.right.left.key == 56
 
     # Symmetric one child case (we need to add another node)
-    tree = AVLTree.from_keys(rvals)
+    tree = insert_keys(rvals)
     tree.insert(45)
     tree.delete(45)
     assert tree.root.left.right.right is None
 
     # Delete two nodes 
-    tree = AVLTree.from_keys([10, 5, 25, 3, 8])
+    tree = insert_keys([10, 5, 25, 3, 8])
     assert tree.root.key == 10
     assert tree.root.left.key == 5
     assert tree.root.right.key == 25
@@ -339,12 +464,407 @@ def test_del():
     emtree = AVLTree()
     assert_raises(KeyError, emtree.delete, 1)
 
+def test_from_sorted():
+    keys = list(range(0, 200, 3))
+    tree = AVLTree.from_sorted(keys)
+    check_tree(tree)
+    assert list(tree.keys()) == keys
+    assert tree.root.height == 7
+
+    for n in range(20):
+        check_tree(AVLTree.from_sorted(range(n)))
+
+    assert AVLTree.from_sorted([]).root is None
+    assert_raises(ValueError, AVLTree.from_sorted, [1, 3, 2])
+    assert_raises(ValueError, AVLTree.from_sorted, [1, 2, 2])
+
+def test_from_keys():
+    keys = [69, 60, 22, 91, 19, 71, 96, 27, 84, 43]
+    tree = AVLTree.from_keys(keys)
+    check_tree(tree)
+    assert list(tree.keys()) == sorted(keys)
+
+    tree = AVLTree.from_keys(iter(range(100)))
+    check_tree(tree)
+    assert list(tree.keys()) == list(range(100))
+
+    assert_raises(ValueError, AVLTree.from_keys, [3, 1, 3])
+
+def test_random_mutation():
+    rng = random.Random(3)
+    tree = AVLTree()
+    expected = set()
+
+    for i in range(3000):
+        key = rng.randrange(400)
+        if key in expected:
+            tree.delete(key)
+            expected.remove(key)
+        else:
+            tree.insert(key)
+            expected.add(key)
+        assert len(tree) == len(expected)
+        if i % 100 == 0:
+            check_tree(tree)
+            assert list(tree.keys()) == sorted(expected)
+
+    for key in list(expected):
+        tree.delete(key)
+    assert tree.root is None and len(tree) == 0
+
+def test_delete_root():
+    for n in range(1, 30):
+        tree = AVLTree.from_keys(range(n))
+        removed = tree.root.key
+        tree.delete(removed)
+        check_tree(tree)
+        assert list(tree.keys()) == [k for k in range(n) if k != removed]
+
+def test_bulk_queries():
+    tree = AVLTree.from_keys(range(0, 1000, 5))
+    # Few queries are answered by descents, many from a flattened copy
+    for queries in [[7, 995, 0, -3, 1200], list(range(-5, 1010))]:
+        kinds = [list]
+        if numpy is not None:
+            kinds.append(numpy.array)
+        for kind in kinds:
+            q = kind(queries)
+            assert list(tree.contains_many(q)) == [k in tree for k in queries]
+            assert list(tree.rank_many(q)) == [tree.rank(k) for k in queries]
+            assert list(tree.floor_many(q, None)) == [
+                tree.floor(k) if k >= 0 else None for k in queries]
+            assert list(tree.ceiling_many(q, None)) == [
+                tree.ceiling(k) if k <= 995 else None for k in queries]
+            assert_raises(KeyError, tree.floor_many, q)
+            assert_raises(KeyError, tree.ceiling_many, q)
+            assert list(tree.floor_many(kind([7, 995]))) == [5, 995]
+
+    empty = AVLTree()
+    assert empty.contains_many([1, 2]) == [False, False]
+    assert empty.rank_many([1]) == [0]
+    assert empty.floor_many([1], None) == [None]
+    many = list(range(200))
+    assert empty.floor_many(many, 0) == [0] * 200
+    assert empty.ceiling_many(many, None) == [None] * 200
+    assert_raises(KeyError, empty.floor_many, many)
+    if numpy is not None:
+        many = numpy.array(many)
+        assert list(empty.floor_many(many, default=0)) == [0] * 200
+        assert list(empty.ceiling_many(many, default=-1)) == [-1] * 200
+        assert list(empty.contains_many(many)) == [False] * 200
+        assert list(empty.rank_many(many)) == [0] * 200
+        assert_raises(KeyError, empty.ceiling_many, many)
+
+    tree = AVLTree.from_array([5, 3, 5, 1, 3])
+    assert list(tree.keys()) == [1, 3, 5]
+    check_tree(tree)
+    if numpy is not None:
+        tree = AVLTree.from_array(numpy.array([5, 3, 5, 1, 3]))
+        assert list(tree.keys()) == [1, 3, 5]
+        assert all(type(key) is int for key in tree.keys())
+
+def test_climb():
+    tree = AVLTree.from_sorted(range(0, 1000, 10))
+    for node in tree.traverse():
+        for key in [-5, 0, 5, 10, 15, 333, 995, 2000]:
+            start = tree.climb(node, key)
+            assert tree.locate(key, start) == tree.locate(key)
+
+    # Past either end the climb stays where it is
+    assert tree.climb(tree.max_node(), 5000) is tree.max_node()
+    assert tree.climb(tree.min_node(), -5000) is tree.min_node()
+
+def test_finger():
+    def check_finger(tree):
+        # The finger, if any, is a node still linked into the tree
+        node = tree.finger
+        if node is not None:
+            while node.parent is not None:
+                node = node.parent
+            assert node is tree.root
+
+    rng = random.Random(17)
+    tree = AVLTree(finger=True)
+    present = set()
+    key = 0
+    for _ in range(3000):
+        # Mostly short steps from the last key, with the odd jump
+        key = (key + rng.randint(-5, 5) if rng.random() < 0.9 else
+               rng.randrange(1000))
+        if key in present:
+            assert tree.find_node(key).key == key
+            tree.delete(key)
+            present.remove(key)
+        else:
+            assert_raises(KeyError, tree.find_node, key)
+            tree.insert(key)
+            present.add(key)
+        assert (key in tree) == (key in present)
+        check_finger(tree)
+    check_tree(tree)
+    assert list(tree.keys()) == sorted(present)
+    assert_raises(ValueError, tree.insert, key if key in present else min(present))
+
+    tree.delete_many(sorted(present)[::3])
+    check_finger(tree)
+    below, above = tree.split(500)
+    assert below.finger_search and below.finger is None
+    check_finger(tree)
+    joined = AVLTree.join(below, above)
+    joined.find_node(joined.max())
+    del joined[joined.min():joined.max()]
+    check_finger(joined)
+    assert list(joined) == [joined.max()] and joined.max() in joined
+
+    copy = pickle.loads(pickle.dumps(tree))
+    assert copy.finger_search and copy.finger is None
+    keyed = AVLTree.from_keys([-3, 1, 2], key=abs, finger=True)
+    assert -1 in keyed and 3 in keyed and 4 not in keyed
+    assert AVLTree.from_sorted(range(10), finger=True).finger_search
+    assert not AVLTree.from_sorted(range(10)).finger_search
+
+
+def test_insert_many():
+    for base, batch in [(range(0, 1000, 2), range(1, 40, 2)),
+                        (range(0, 40, 2), range(1, 1000, 2)),
+                        ([], range(100))]:
+        expected = set(base) | set(batch)
+        tree = AVLTree.from_keys(base)
+        tree.insert_many(reversed(batch))
+        check_tree(tree)
+        assert list(tree.keys()) == sorted(expected)
+
+    # Both paths leave the tree unchanged when they raise
+    for base, batch in [(range(0, 1000, 2), [1, 3, 10]),
+                        (range(0, 40, 2), list(range(1, 1000, 2)) + [10]),
+                        (range(0, 1000, 2), [1, 5, 5])]:
+        tree = AVLTree.from_keys(base)
+        assert_raises(ValueError, tree.insert_many, batch)
+        check_tree(tree)
+        assert list(tree.keys()) == list(base)
+
+        tree.insert_many(batch, ignore_duplicates=True)
+        check_tree(tree)
+        assert list(tree.keys()) == sorted(set(base) | set(batch))
+
+    m = AVLMap({2: 'two'})
+    m.insert_many(range(1000), ignore_duplicates=True)
+    assert m[2] == 'two' and len(m) == 1000
+    m = AVLMap({2: 'two'})
+    m.insert_many([1, 3])
+    assert list(m.items()) == [(1, None), (2, 'two'), (3, None)]
+
+def test_delete_many():
+    for base, batch in [(range(1000), range(0, 40, 3)),
+                        (range(1000), range(0, 1000, 3)),
+                        (range(100), range(100))]:
+        expected = set(base) - set(batch)
+        tree = AVLTree.from_keys(base)
+        tree.delete_many(reversed(batch))
+        check_tree(tree)
+        assert list(tree.keys()) == sorted(expected)
+
+    for base, batch in [(range(1000), [3, 4, 1001]),
+                        (range(100), list(range(100)) + [-1]),
+                        (range(1000), [3, 5, 5]),
+                        (range(100), list(range(100)) + [99])]:
+        tree = AVLTree.from_keys(base)
+        assert_raises(KeyError, tree.delete_many, batch)
+        check_tree(tree)
+        assert list(tree.keys()) == list(base)
+
+        tree.delete_many(batch, ignore_missing=True)
+        check_tree(tree)
+        assert list(tree.keys()) == sorted(set(base) - set(batch))
+
+def test_split():
+    for n in [0, 1, 2, 10, 100, 333]:
+        for key in [-1, 0, 1, n // 3, n // 2 + 0.5, n - 1, n, n + 5]:
+            tree = AVLTree.from_keys(range(n))
+            below, above = tree.split(key)
+            check_tree(below)
+            check_tree(above)
+            assert list(below.keys()) == [k for k in range(n) if k < key]
+            assert list(above.keys()) == [k for k in range(n) if k >= key]
+            assert tree.root is None
+
+    # Unevenly shaped trees split and rejoin cleanly too
+    tree = insert_keys(random.Random(7).sample(range(1000), 500))
+    keys = list(tree.keys())
+    below, above = tree.split(400)
+    joined = AVLTree.join(below, above)
+    check_tree(joined)
+    assert list(joined.keys()) == keys
+    assert below.root is None and above.root is None
+
+    tree = AVLTree(key=str.lower)
+    tree.insert_many(['a', 'B', 'c', 'D'])
+    below, above = tree.split('c')
+    assert list(below) == ['a', 'B'] and list(above) == ['c', 'D']
+    assert above.keyfunc is str.lower
+
+def test_join():
+    for nleft, nright in [(0, 0), (0, 5), (5, 0), (1, 1), (1, 100),
+                          (100, 1), (7, 300), (300, 7), (64, 64)]:
+        left = AVLTree.from_keys(range(nleft))
+        right = insert_keys(range(1000, 1000 + nright))
+        joined = AVLTree.join(left, right)
+        check_tree(joined)
+        assert list(joined.keys()) == (list(range(nleft)) +
+                                       list(range(1000, 1000 + nright)))
+
+    assert_raises(ValueError, AVLTree.join, AVLTree.from_keys([1, 5]),
+                  AVLTree.from_keys([3, 8]))
+
+    m = AVLTree.join(AVLMap({1: 'a'}), AVLMap({2: 'b'}))
+    assert isinstance(m, AVLMap) and m[2] == 'b'
+
+def test_delete_range():
+    keys = list(range(0, 200, 2))
+    for lo, hi in [(10, 20), (11, 21), (None, 50), (150, None), (None, None),
+                   (50, 10), (-10, 5), (199, 500), (61, 62)]:
+        tree = AVLTree.from_keys(keys)
+        del tree[lo:hi]
+        check_tree(tree)
+        assert list(tree.keys()) == [k for k in keys if
+                                     (lo is not None and k < lo) or
+                                     (hi is not None and k >= hi) or
+                                     (lo is not None and hi is not None and
+                                      not lo < hi)]
+
+    tree = AVLTree.from_keys(keys)
+    del tree[3]
+    del tree[-1]
+    assert list(tree.keys()) == keys[:3] + keys[4:-1]
+    assert_raises(ValueError, tree.__delitem__, slice(1, 5, 2))
+    assert_raises(TypeError, tree.__getitem__, slice(2, 5))
+
+    m = AVLMap((i, str(i)) for i in range(10))
+    del m[2:5]
+    del m[7]
+    assert list(m.keys()) == [0, 1, 5, 6, 8, 9]
+
+def test_map_views():
+    m = AVLMap({3: 'c', 1: 'a', 2: 'b'})
+    keys, values, items = m.keys(), m.values(), m.items()
+    assert len(keys) == len(values) == len(items) == 3
+    assert keys == {1, 2, 3} and list(keys) == [1, 2, 3]
+    assert list(values) == ['a', 'b', 'c']
+    assert (2, 'b') in items and (2, 'x') not in items
+    assert list(items) == list(items) == [(1, 'a'), (2, 'b'), (3, 'c')]
+    # Views follow later changes
+    m[0] = 'z'
+    assert list(keys)[0] == 0 and list(values)[0] == 'z' and len(items) == 4
+    assert dict(m) == {0: 'z', 1: 'a', 2: 'b', 3: 'c'}
+
+
+def test_map_algebra():
+    a = AVLMap({1: 'a', 2: 'b', 3: 'c'})
+    b = AVLMap({3: 'C', 4: 'D'})
+    for result in [a | b, a & b, a - b, a ^ b]:
+        assert isinstance(result, AVLMap)
+        check_tree(result)
+    assert dict(a | b) == {1: 'a', 2: 'b', 3: 'C', 4: 'D'}
+    assert dict(a | {0: 'x'}) == {0: 'x', 1: 'a', 2: 'b', 3: 'c'}
+    assert dict(a & b) == {3: 'c'}
+    assert dict(a - b) == {1: 'a', 2: 'b'}
+    assert dict(a ^ b) == {1: 'a', 2: 'b', 4: 'D'}
+    assert dict(a & AVLTree.from_keys([1, 5])) == {1: 'a'}
+    assert_raises(TypeError, a.union, AVLTree.from_keys([1]))
+
+    c = AVLMap(a)
+    c |= b
+    assert dict(c) == dict(a | b)
+    c ^= {1: 'x', 9: 'y'}
+    check_tree(c)
+    assert dict(c) == {2: 'b', 3: 'C', 4: 'D', 9: 'y'}
+    c &= AVLMap({2: None, 9: None})
+    assert dict(c) == {2: 'b', 9: 'y'}
+    c -= AVLMap({9: None})
+    assert dict(c) == {2: 'b'}
+    assert_raises(TypeError, c.__ior__, AVLTree.from_keys([1]))
+
+    # Plain mappings are taken in any key order
+    big = AVLMap({i: i for i in range(1000)})
+    assert len(big - {5: 0, 3: 0}) == 998
+    assert dict(big & {5: 0, 3: 0}) == {3: 3, 5: 5}
+    assert dict(a & {i: 0 for i in range(999, -1, -1)}) == dict(a)
+    assert a.issubset({2: 0, 1: 0, 3: 0}) and not a.issubset({3: 0, 1: 0})
+    assert a.issuperset({3: 0, 1: 0}) and not a.issuperset({5: 0, 1: 0})
+    assert a.isdisjoint({9: 0, 0: 0}) and not a.isdisjoint({9: 0, 2: 0})
+    big -= {7: 0}
+    big &= {9: 0, 7: 0, 8: 0}
+    check_tree(big)
+    assert dict(big) == {8: 8, 9: 9}
+
+
+def test_hash_index():
+    rng = random.Random(16)
+    tree = AVLTree(hash_index=True)
+    present = set()
+    for _ in range(2000):
+        key = rng.randrange(300)
+        if key in present:
+            tree.delete(key)
+            present.remove(key)
+        else:
+            tree.insert(key)
+            present.add(key)
+        assert (key in tree) == (key in present)
+    check_tree(tree)
+
+    tree.insert_many(range(0, 300, 7), ignore_duplicates=True)
+    tree.delete_many(range(0, 300, 5), ignore_missing=True)
+    present = (present | set(range(0, 300, 7))) - set(range(0, 300, 5))
+    check_tree(tree)
+    assert list(tree.keys()) == sorted(present)
+    assert tree.find_node(7).key == 7
+    assert_raises(KeyError, tree.find_node, 5)
+    assert tree.successor(7) == min(k for k in present if k > 7)
+    assert tree.predecessor(7) == max(k for k in present if k < 7)
+    assert_raises(KeyError, tree.predecessor, tree.min())
+    assert tree.floor(7) == tree.ceiling(7) == 7
+
+    other = AVLTree.from_keys(range(100, 400, 3))
+    for result in [tree | other, tree & other, tree - other, tree ^ other]:
+        assert result.index is not None
+        check_tree(result)
+    for op in ['__ior__', '__iand__', '__isub__', '__ixor__']:
+        copy = AVLTree.from_keys(present, hash_index=True)
+        getattr(copy, op)(other)
+        check_tree(copy)
+
+    below, above = tree.split(150)
+    check_tree(tree)
+    check_tree(below)
+    check_tree(above)
+    joined = AVLTree.join(below, above)
+    check_tree(joined)
+    del joined[50:100]
+    check_tree(joined)
+    check_tree(pickle.loads(pickle.dumps(joined)))
+
+    m = AVLMap(((i, str(i)) for i in range(10)), hash_index=True)
+    m[20] = 'x'
+    del m[3]
+    check_tree(m)
+    assert m[20] == 'x' and 3 not in m
+
 def test_intersect():
     t1 = AVLTree.from_keys([1, 3, 5, 7, 9])
     t2 = AVLTree.from_keys([3,6,7])
 
     t_intersect = t1.intersection(t2)
     assert [x.key for x in t_intersect.traverse()] == [3,7]
+    check_tree(t_intersect)
+
+    assert t1.intersection(AVLTree()).root is None
+
+    t1 = AVLTree.from_keys(range(0, 1000, 2))
+    t2 = AVLTree.from_keys(range(0, 1000, 3))
+    t_intersect = t1.intersection(t2)
+    check_tree(t_intersect)
+    assert list(t_intersect.keys()) == list(range(0, 1000, 6))
 
 def test_union():
     t1 = AVLTree.from_keys([1, 3, 5, 7, 9])
@@ -352,6 +872,75 @@ def test_union():
 
     t_union = t1.union(t2)
     assert [x.key for x in t_union.traverse()] == [1,3,5,6,7,9] 
+    check_tree(t_union)
+
+    assert list(t1.union(AVLTree()).keys()) == [1, 3, 5, 7, 9]
+    assert list(AVLTree().union(t2).keys()) == [3, 6, 7]
+
+    t1 = AVLTree.from_keys(range(0, 1000, 2))
+    t2 = AVLTree.from_keys(range(0, 1000, 3))
+    t_union = t1.union(t2)
+    check_tree(t_union)
+    assert list(t_union.keys()) == sorted(set(range(0, 1000, 2)) |
+                                          set(range(0, 1000, 3)))
+
+def test_set_algebra():
+    rng = random.Random(15)
+    # Equal sizes take the merge paths, skewed sizes the search paths
+    for na, nb in [(300, 300), (5, 3000), (3000, 5), (0, 50), (40, 0)]:
+        a = set(rng.sample(range(4000), na))
+        b = set(rng.sample(range(4000), nb))
+        ta, tb = AVLTree.from_keys(a), AVLTree.from_keys(b)
+
+        for result, expected in [(ta & tb, a & b), (ta | tb, a | b),
+                                 (ta - tb, a - b), (ta ^ tb, a ^ b)]:
+            check_tree(result)
+            assert list(result.keys()) == sorted(expected)
+
+        assert ta.issubset(tb) == (a <= b)
+        assert ta.issuperset(tb) == (a >= b)
+        assert ta.isdisjoint(tb) == a.isdisjoint(b)
+        assert ta.issubset(ta | tb)
+        assert (ta | tb).issuperset(tb)
+        assert (ta - tb).isdisjoint(tb)
+
+        for op in ['__ior__', '__iand__', '__isub__', '__ixor__']:
+            t = AVLTree.from_keys(a)
+            assert getattr(t, op)(tb) is t
+            check_tree(t)
+            assert list(t.keys()) == sorted(getattr(set(a), op)(b))
+
+def test_set_algebra_keyed():
+    stamp = lambda r: r.stamp
+    records = [Record('n{}'.format(i), i) for i in range(50)]
+    a = AVLTree.from_keys(records[:30], key=stamp)
+    b = AVLTree.from_keys(records[20:], key=stamp)
+
+    assert [r.stamp for r in (a - b).elements()] == list(range(20))
+    assert [r.stamp for r in (a ^ b).elements()] == (list(range(20)) +
+                                                     list(range(30, 50)))
+
+    # Elements only move between trees with the same key function
+    plain = AVLTree.from_keys(range(45, 55))
+    frozen = FrozenAVLTree.from_sorted(range(45, 55))
+    for other in (plain, frozen, AVLTree(key=lambda r: r.stamp)):
+        for op in ('union', 'symmetric_difference', '__ior__', '__ixor__'):
+            assert_raises(TypeError, getattr(b, op), other)
+    assert list(b.keys()) == list(range(20, 50))
+    assert_raises(TypeError, plain.union, b)
+    assert_raises(TypeError, plain.symmetric_difference, b)
+    copy = AVLTree.from_keys(range(45, 55))
+    assert_raises(TypeError, copy.__ior__, b)
+    assert_raises(TypeError, copy.__ixor__, b)
+    assert list(copy.keys()) == list(range(45, 55))
+
+    a &= AVLTree.from_keys(records[25:26], key=stamp)
+    check_tree(a)
+    assert list(a.elements()) == [records[25]]
+    a ^= b
+    check_tree(a)
+    assert [r.stamp for r in a.elements()] == (list(range(20, 25)) +
+                                               list(range(26, 50)))
 
 def test_selfbalancing():
     tree = AVLTree()
@@ -392,6 +981,220 @@ def test_selfbalancing():
         for x in tree.traverse():
             assert x.verify()
 
+def test_order_statistics():
+    rvals = [48, 23, 74, 3, 44, 64, 98, 41, 56, 91]
+    srt = sorted(rvals)
+    tree = insert_keys(rvals)
+    check_tree(tree)
+
+    for i, key in enumerate(srt):
+        assert tree.select(i) == key
+        assert tree[i] == key
+        assert tree[i - len(srt)] == key
+        assert tree.rank(key) == i
+        assert tree.rank(key + 0.5) == i + 1
+    assert tree.rank(-1) == 0
+    assert_raises(IndexError, tree.select, len(srt))
+    assert_raises(IndexError, tree.select, -len(srt) - 1)
+    assert_raises(IndexError, AVLTree().select, 0)
+    assert list(tree) == srt
+
+    for key in [64, 3, 48, 74, 98]:
+        tree.delete(key)
+        srt.remove(key)
+        check_tree(tree)
+        assert len(tree) == len(srt)
+        assert [tree[i] for i in range(len(tree))] == srt
+
+def test_irange():
+    keys = list(range(0, 100, 5))
+    tree = AVLTree.from_keys(keys)
+
+    assert list(tree.irange(10, 30)) == [10, 15, 20, 25]
+    assert list(tree.irange(10, 30, inclusive=(False, True))) == [15, 20, 25, 30]
+    assert list(tree.irange(11, 29)) == [15, 20, 25]
+    assert list(tree.irange(10, 30, reverse=True)) == [25, 20, 15, 10]
+    assert list(tree.irange(10, 30, inclusive=(False, True),
+                            reverse=True)) == [30, 25, 20, 15]
+    assert list(tree.irange()) == keys
+    assert list(tree.irange(reverse=True)) == keys[::-1]
+    assert list(tree.irange(hi=12)) == [0, 5, 10]
+    assert list(tree.irange(lo=87)) == [90, 95]
+    assert list(tree.irange(30, 10)) == []
+    assert list(tree.irange(31, 34)) == []
+    assert list(AVLTree().irange(1, 2)) == []
+
+    for lo in range(-3, 103, 7):
+        for hi in range(lo, 103, 11):
+            expected = [k for k in keys if lo <= k <= hi]
+            assert list(tree.irange(lo, hi, (True, True))) == expected
+            assert list(tree.irange(lo, hi, (True, True), True)) == expected[::-1]
+
+def test_neighbors():
+    tree = AVLTree.from_keys([10, 20, 30, 40])
+
+    assert tree.floor(20) == 20
+    assert tree.floor(25) == 20
+    assert tree.ceiling(20) == 20
+    assert tree.ceiling(25) == 30
+    assert tree.predecessor(20) == 10
+    assert tree.predecessor(25) == 20
+    assert tree.successor(20) == 30
+    assert tree.successor(25) == 30
+    assert tree.floor(100) == 40
+    assert tree.ceiling(-100) == 10
+
+    assert_raises(KeyError, tree.floor, 5)
+    assert_raises(KeyError, tree.ceiling, 45)
+    assert_raises(KeyError, tree.predecessor, 10)
+    assert_raises(KeyError, tree.successor, 40)
+    assert_raises(KeyError, AVLTree().floor, 1)
+
+def test_map():
+    m = AVLMap()
+    m[5] = 'five'
+    m[1] = 'one'
+    m[3] = 'three'
+    assert m[3] == 'three'
+    assert len(m) == 3 and 1 in m and 2 not in m
+    assert_raises(KeyError, m.__getitem__, 2)
+
+    node = m.find_node(5)
+    m[5] = 'FIVE'
+    assert m[5] == 'FIVE' and m.find_node(5) is node
+    assert len(m) == 3
+
+    assert list(m.keys()) == [1, 3, 5]
+    assert list(m.values()) == ['one', 'three', 'FIVE']
+    assert list(m.items()) == [(1, 'one'), (3, 'three'), (5, 'FIVE')]
+    assert list(m) == [1, 3, 5]
+
+    assert m.get(3) == 'three' and m.get(4) is None and m.get(4, 0) == 0
+    assert m.setdefault(3, 'x') == 'three'
+    assert m.setdefault(4, 'four') == 'four' and m[4] == 'four'
+
+    del m[3]
+    assert 3 not in m and len(m) == 3
+    assert_raises(KeyError, m.__delitem__, 3)
+    assert m.pop(1) == 'one'
+    m.update({10: 'ten', 0: 'zero'})
+    assert dict(m) == {0: 'zero', 4: 'four', 5: 'FIVE', 10: 'ten'}
+    check_tree(m)
+
+    m.clear()
+    assert len(m) == 0
+
+    m = AVLMap([(3, 'c'), (1, 'a'), (2, 'b'), (1, 'A')])
+    check_tree(m)
+    assert list(m.items()) == [(1, 'A'), (2, 'b'), (3, 'c')]
+    assert m == {1: 'A', 2: 'b', 3: 'c'}
+
+class Record(object):
+    def __init__(self, name, stamp):
+        self.name, self.stamp = name, stamp
+
+def test_key_function():
+    stamp = lambda r: r.stamp
+    records = [Record(name, i * 10) for i, name in enumerate('hcbgadfe')]
+    tree = AVLTree(key=stamp)
+    for rec in reversed(records):
+        tree.insert(rec)
+    check_tree(tree)
+
+    assert list(tree) == records
+    assert list(tree.keys()) == [r.stamp for r in records]
+    assert all(isinstance(node.key, int) for node in tree.traverse())
+    assert records[2] in tree
+    assert Record('z', 20) in tree and Record('z', 25) not in tree
+    assert tree.contains_key(30) and not tree.contains_key(35)
+    assert tree.find_node(30).value is records[3]
+    assert tree.select_node(0).value is records[0]
+    assert [n.value.name for n in tree.irange_nodes(20, 50)] == list('bga')
+    assert_raises(ValueError, tree.insert, Record('z', 40))
+
+    tree.delete(records[3])
+    assert not tree.contains_key(30)
+    assert_raises(KeyError, tree.delete, records[3])
+
+    tree = AVLTree.from_keys(reversed(records), key=stamp)
+    check_tree(tree)
+    assert list(tree) == records
+    assert list(AVLTree.from_sorted(records, key=stamp)) == records
+    assert_raises(ValueError, AVLTree.from_keys, records * 2, key=stamp)
+
+    tree = AVLTree(key=stamp)
+    tree.insert_many(records[::2])
+    tree.insert_many(records[1::2])
+    assert list(tree) == records
+    tree.delete_many(records[:4])
+    assert list(tree) == records[4:]
+
+    odd = AVLTree.from_keys(records[1::2], key=stamp)
+    low = AVLTree.from_keys(records[:4], key=stamp)
+    assert list(odd.union(low)) == records[:4] + records[5::2]
+    assert list(odd.intersection(low)) == records[1:4:2]
+    assert odd.union(low).keyfunc is stamp
+
+    words = AVLTree(key=str.lower)
+    words.insert_many(['b', 'A', 'c'])
+    assert list(words) == ['A', 'b', 'c'] and 'a' in words
+
+def test_snapshot():
+    cases = [list(range(-5, 100000, 7)),
+             [0.5 * i for i in range(100)],
+             [bytes([i, i]) * i for i in range(50)],
+             ['apple', 'banana', 'cherry'],
+             [2 ** 70 + i for i in range(10)],
+             []]
+    for keys in cases:
+        buf = io.BytesIO()
+        AVLTree.from_sorted(keys).dump(buf)
+        buf.seek(0)
+        tree = AVLTree.load(buf)
+        check_tree(tree)
+        assert list(tree.keys()) == keys
+        assert [type(k) for k in tree.keys()] == [type(k) for k in keys]
+
+    # Packed ints take about 8 bytes a key
+    buf = io.BytesIO()
+    AVLTree.from_sorted(range(100000)).dump(buf)
+    assert len(buf.getvalue()) < 8 * 100000 + 100
+
+    assert_raises(ValueError, AVLTree.load, io.BytesIO(b'junk'))
+    assert_raises(ValueError, AVLTree.load, io.BytesIO(buf.getvalue()[:-20]))
+
+    records = [Record(name, i) for i, name in enumerate('abc')]
+    buf = io.BytesIO()
+    AVLTree.from_keys(records, key=lambda r: r.stamp).dump(buf)
+    buf.seek(0)
+    tree = AVLTree.load(buf, key=lambda r: r.stamp)
+    assert [r.name for r in tree] == ['a', 'b', 'c']
+    assert tree.contains_key(2)
+
+    m = AVLMap({3: 'c', 1: 'a', 2: ['b']})
+    buf = io.BytesIO()
+    m.dump(buf)
+    buf.seek(0)
+    loaded = AVLMap.load(buf)
+    check_tree(loaded)
+    assert list(loaded.items()) == [(1, 'a'), (2, ['b']), (3, 'c')]
+
+def test_pickle():
+    tree = AVLTree.from_keys(range(100000))
+    copy = pickle.loads(pickle.dumps(tree))
+    check_tree(copy)
+    assert len(copy) == 100000 and list(copy.keys()) == list(tree.keys())
+
+    tree = AVLTree(key=str.lower)
+    tree.insert_many(['b', 'A'])
+    copy = pickle.loads(pickle.dumps(tree))
+    assert list(copy) == ['A', 'b'] and 'a' in copy
+
+    m = AVLMap({'x': 1, 'y': 2})
+    copy = pickle.loads(pickle.dumps(m))
+    assert isinstance(copy, AVLMap) and dict(copy) == {'x': 1, 'y': 2}
+    check_tree(copy)
+
 def test_special():
     # __contains__
     tree = AVLTree.from_keys([10, 5, 8, 3, 20])
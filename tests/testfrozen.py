@@ -0,0 +1,56 @@
+import os
+import tempfile
+
+from nose.tools import assert_raises
+from avl import AVLTree, FrozenAVLTree
+
+from testavl import check_same
+
+# Keys probed around the test trees' range of 0 to 99
+PROBES = range(-3, 110)
+
+
+def test_in_memory():
+    tree = AVLTree.from_keys(range(0, 100, 3))
+    check_same(tree.freeze(), tree, PROBES)
+
+    tree = AVLTree.from_keys([0.5 * i for i in range(200)])
+    frozen = tree.freeze()
+    assert list(frozen) == list(tree) and 2.5 in frozen
+
+def test_file():
+    with tempfile.TemporaryDirectory() as tmp:
+        check_file(os.path.join(tmp, 'keys.avl'))
+
+def check_file(path):
+    tree = AVLTree.from_keys(range(0, 100, 3))
+    with tree.freeze(path) as frozen:
+        check_same(frozen, tree, PROBES)
+
+    with FrozenAVLTree.open(path) as frozen:
+        check_same(frozen, tree, PROBES)
+
+    with AVLTree().freeze(path) as frozen:
+        assert len(frozen) == 0 and 1 not in frozen
+        assert_raises(KeyError, frozen.min)
+
+    with open(path, 'wb') as f:
+        f.write(b'nope' * 20)
+    assert_raises(ValueError, FrozenAVLTree.open, path)
+
+def test_errors():
+    assert_raises(TypeError, AVLTree.from_keys(['a', 'b']).freeze)
+    assert_raises(ValueError, FrozenAVLTree.from_sorted, [1, 3, 2])
+
+def test_setops():
+    with tempfile.TemporaryDirectory() as tmp:
+        check_setops(os.path.join(tmp, 'keys.avl'))
+
+def check_setops(path):
+    t1 = AVLTree.from_keys([1, 3, 5, 7, 9])
+    t2 = AVLTree.from_keys([3, 6, 7])
+    with t2.freeze(path) as frozen:
+        assert list(t1.union(frozen)) == [1, 3, 5, 6, 7, 9]
+        assert list(t1.intersection(frozen)) == [3, 7]
+        assert list(frozen.union(t1)) == [1, 3, 5, 6, 7, 9]
+        assert list(frozen.intersection(t1)) == [3, 7]
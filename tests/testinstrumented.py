@@ -0,0 +1,80 @@
+import pickle
+import random
+
+from nose.tools import assert_raises
+from avl import AVLTree, InstrumentedAVLTree
+
+from testavl import check_tree
+
+
+def test_counters():
+    tree = InstrumentedAVLTree()
+    for key in range(1000):
+        tree.insert(key)
+    check_tree(tree)
+
+    inserts = tree.metrics()['operations']['insert']
+    assert inserts['calls'] == 1000
+    # Ascending inserts only ever rotate left, about once per insert
+    rotations = inserts['rotations']
+    assert rotations['right'] == rotations['double_right'] == 0
+    assert 900 < rotations['left'] + rotations['double_left'] < 1000
+    assert inserts['rebalances'] >= sum(rotations.values())
+    assert sum(inserts['latency_us'].values()) == 1000
+
+    # A lookup compares against each node on its path
+    tree.reset_metrics()
+    path = list(tree.path_to_root(0))
+    assert 0 in tree
+    tree.find_node(0)
+    operations = tree.metrics()['operations']
+    for name in ('path_to_root', '__contains__', 'find_node'):
+        assert operations[name]['calls'] == 1
+        assert operations[name]['nodes_visited'] == len(path)
+        assert len(path) <= operations[name]['comparisons'] <= 3 * len(path)
+
+    metrics = tree.metrics()
+    assert metrics['height'] == tree.root.height
+    assert metrics['size'] == 1000
+    assert set(metrics) == {'height', 'size', 'operations'}
+
+
+def test_same_as_avltree():
+    rng = random.Random(24)
+    keys = rng.sample(range(5000), 2000)
+    tree = InstrumentedAVLTree.from_keys(keys[:1000], hash_index=True)
+    plain = AVLTree.from_keys(keys[:1000])
+    tree.insert_many(keys[1000:])
+    plain.insert_many(keys[1000:])
+    tree.delete_many(keys[::3])
+    plain.delete_many(keys[::3])
+    for key in keys[1::3]:
+        tree.delete(key)
+        plain.delete(key)
+    check_tree(tree)
+    assert list(tree.keys()) == list(plain.keys())
+
+    assert_raises(ValueError, tree.insert, tree.min())
+    assert_raises(KeyError, tree.delete, -1)
+    try:
+        tree.find_node(-1)
+    except KeyError as e:
+        assert str(e) == repr('Key not found: -1')
+    else:
+        assert False, 'missing key found'
+
+    operations = tree.metrics()['operations']
+    assert set(operations) >= {'insert_many', 'delete_many', 'delete',
+                               'insert', 'find_node'}
+    assert operations['delete']['calls'] == len(keys[1::3]) + 1
+    assert operations['find_node']['calls'] == 1
+
+    keyed = InstrumentedAVLTree(key=abs)
+    keyed.insert_many([-3, 1, 2])
+    assert -1 in keyed and 3 in keyed and 4 not in keyed
+    assert keyed.metrics()['operations']['__contains__']['calls'] == 3
+
+    copy = pickle.loads(pickle.dumps(tree))
+    assert list(copy.keys()) == list(tree.keys())
+    below, above = tree.split(2500)
+    assert below.metrics()['operations'] == {}
@@ -0,0 +1,130 @@
+import io
+import pickle
+import random
+from collections import Counter
+
+from nose.tools import assert_raises
+from avl import AVLMultiset, AVLTree
+
+from testavl import check_tree
+
+
+def check_multiset(tree, counter):
+    check_tree(tree)
+
+    def check(node):
+        if node is None:
+            return 0
+        assert node.count > 0
+        assert node.total == check(node.left) + check(node.right) + node.count
+        return node.total
+    check(tree.root)
+
+    assert len(tree) == sum(counter.values())
+    assert list(tree.items()) == sorted(counter.items())
+    assert list(tree) == sorted(counter.elements())
+    assert list(tree.keys()) == sorted(counter)
+
+
+def test_counts():
+    rng = random.Random(25)
+    tree = AVLMultiset(hash_index=True)
+    counter = Counter()
+    for _ in range(3000):
+        key = rng.randrange(60)
+        if counter[key] and rng.random() < 0.45:
+            count = rng.randint(1, counter[key])
+            tree.remove(key, count)
+            counter[key] -= count
+            counter += Counter()
+        else:
+            count = rng.choice([1, 1, 1, 5])
+            tree.add(key, count)
+            counter[key] += count
+    check_multiset(tree, counter)
+
+    elements = sorted(counter.elements())
+    for key in range(-1, 62):
+        assert tree.count(key) == counter[key]
+        assert tree.rank(key) == sum(1 for x in elements if x < key)
+    assert [tree[i] for i in range(len(tree))] == elements
+    assert tree[-1] == elements[-1]
+    assert_raises(IndexError, tree.select, len(tree))
+    assert tree.rank_many([0, 30]) == [tree.rank(0), tree.rank(30)]
+
+    key = tree.min()
+    assert_raises(ValueError, tree.remove, key, counter[key] + 1)
+    assert_raises(ValueError, tree.add, key, 0)
+    assert_raises(KeyError, tree.remove, -1)
+
+    # delete drops every occurrence, del tree[i] a single one
+    tree.delete(key)
+    del counter[key]
+    first = tree.min()
+    del tree[0]
+    counter[first] -= 1
+    counter += Counter()
+    check_multiset(tree, counter)
+
+
+def test_build():
+    keys = [5, 1, 3, 5, 5, 1, 9]
+    tree = AVLMultiset(keys)
+    check_multiset(tree, Counter(keys))
+    assert AVLMultiset.from_keys(keys).count(5) == 3
+    assert list(AVLMultiset.from_counts({2: 2, 1: 0, 4: 1})) == [2, 2, 4]
+    assert list(AVLMultiset.from_counts([(2, 1), (2, 3)]).items()) == [(2, 4)]
+    assert_raises(ValueError, AVLMultiset.from_counts, [(1, -1)])
+
+    tree.insert_many([9, 9, 0])
+    tree.insert(0)
+    check_multiset(tree, Counter(keys + [9, 9, 0, 0]))
+
+    counter = Counter(keys + [9, 9, 0, 0])
+    buf = io.BytesIO()
+    tree.dump(buf)
+    buf.seek(0)
+    check_multiset(AVLMultiset.load(buf), counter)
+    check_multiset(pickle.loads(pickle.dumps(tree)), counter)
+
+    below, above = tree.split(4)
+    check_multiset(below, Counter({0: 2, 1: 2, 3: 1}))
+    check_multiset(above, Counter({5: 3, 9: 3}))
+    joined = AVLMultiset.join(below, above)
+    check_multiset(joined, counter)
+
+    del joined[1:6]
+    check_multiset(joined, Counter({0: 2, 9: 3}))
+
+    many = AVLMultiset(range(1000))
+    many.delete_many(range(0, 1000, 2))
+    check_multiset(many, Counter(range(1, 1000, 2)))
+
+
+def test_algebra():
+    rng = random.Random(25)
+    a = [rng.randrange(20) for _ in range(100)]
+    b = [rng.randrange(20) for _ in range(80)]
+    x, y = AVLMultiset(a), AVLMultiset(b)
+    ca, cb = Counter(a), Counter(b)
+
+    check_multiset(x | y, ca | cb)
+    check_multiset(x & y, ca & cb)
+    check_multiset(x - y, ca - cb)
+    check_multiset(x ^ y, (ca - cb) + (cb - ca))
+    check_multiset(x | AVLTree.from_keys(range(30)), ca | Counter(range(30)))
+
+    assert (x & y).issubset(x) and x.issuperset(x & y)
+    assert not x.issubset(x & y)
+
+    x |= y
+    expected = ca | cb
+    check_multiset(x, expected)
+    x -= y
+    expected -= cb
+    check_multiset(x, expected)
+    x ^= y
+    expected = (expected - cb) + (cb - expected)
+    check_multiset(x, expected)
+    x &= y
+    check_multiset(x, expected & cb)
@@ -0,0 +1,35 @@
+import random
+
+from nose.tools import assert_raises
+from avl import AVLTree
+from avl import parallel
+
+
+def with_small_tasks(test):
+    # Send even small inputs to the workers, in many little tasks
+    def run():
+        saved = parallel.PARALLEL_MIN, parallel.TASK_SIZE
+        parallel.PARALLEL_MIN, parallel.TASK_SIZE = 0, 50
+        try:
+            test()
+        finally:
+            parallel.PARALLEL_MIN, parallel.TASK_SIZE = saved
+    run.__name__ = test.__name__
+    return run
+
+
+@with_small_tasks
+def test_sort_keys():
+    rng = random.Random(19)
+    keys = [rng.randrange(500) for _ in range(1000)]
+    assert parallel.sort_keys(keys, 3) == sorted(keys)
+    assert parallel.sort_keys([], 3) == []
+    assert parallel.sort_keys(keys, None) == sorted(keys)
+
+
+@with_small_tasks
+def test_from_keys():
+    keys = random.Random(19).sample(range(10000), 1000)
+    tree = AVLTree.from_keys(keys, workers=3)
+    assert list(tree.keys()) == sorted(keys)
+    assert_raises(ValueError, AVLTree.from_keys, keys + keys[:1], workers=3)
@@ -0,0 +1,104 @@
+import random
+
+from nose.tools import assert_raises
+from avl import AVLTree, PersistentAVLTree
+
+
+def check_tree(tree):
+    # Verify balance, ordering, heights and sizes
+    def check(node, lo, hi):
+        if node is None:
+            return 0
+        assert lo is None or node.key > lo
+        assert hi is None or node.key < hi
+        lh = check(node.left, lo, node.key)
+        rh = check(node.right, node.key, hi)
+        assert abs(lh - rh) <= 1
+        assert node.height == max(lh, rh) + 1
+        assert node.size == sum(c.size for c in node.children
+                                if c is not None) + 1
+        return node.height
+
+    check(tree.root, None, None)
+
+
+def nodes(tree):
+    found, stack = set(), [tree.root]
+    while stack:
+        node = stack.pop()
+        if node is not None:
+            found.add(id(node))
+            stack.extend(node.children)
+    return found
+
+
+def test_versions():
+    rng = random.Random(22)
+    versions = [PersistentAVLTree()]
+    expected = [set()]
+    for _ in range(1000):
+        tree, keys = versions[-1], expected[-1]
+        key = rng.randrange(300)
+        if key in keys:
+            tree = tree.delete(key)
+            keys = keys - {key}
+        else:
+            tree = tree.insert(key)
+            keys = keys | {key}
+        versions.append(tree)
+        expected.append(keys)
+
+    # Every old version still holds exactly its own keys
+    for tree, keys in zip(versions[::50], expected[::50]):
+        check_tree(tree)
+        assert list(tree.keys()) == sorted(keys)
+        assert len(tree) == len(keys)
+
+    tree = versions[-1]
+    assert_raises(ValueError, tree.insert, tree.min())
+    assert_raises(KeyError, tree.delete, -1)
+    assert tree.snapshot() is tree
+
+
+def test_sharing():
+    tree = PersistentAVLTree.from_sorted(range(10000))
+    before = nodes(tree)
+    for key in [-1, 5000.5, 12345]:
+        # Only the nodes on the path to the key are new
+        changed = tree.insert(key)
+        assert len(nodes(changed) - before) <= 2 * tree.root.height
+        changed = tree.delete(int(key) % 10000)
+        assert len(nodes(changed) - before) <= 2 * tree.root.height
+    assert list(tree.keys()) == list(range(10000))
+
+
+def test_queries():
+    keys = list(range(0, 100, 3))
+    tree = PersistentAVLTree.from_keys(reversed(keys))
+    reference = AVLTree.from_keys(keys)
+    check_tree(tree)
+    assert_raises(ValueError, PersistentAVLTree.from_sorted, [1, 1])
+
+    assert tree.min() == 0 and tree.max() == 99
+    assert [tree[i] for i in range(len(tree))] == keys
+    assert_raises(IndexError, tree.select, len(tree))
+    for probe in range(-2, 103):
+        assert (probe in tree) == (probe in reference)
+        assert tree.rank(probe) == reference.rank(probe)
+        for name in ('floor', 'ceiling', 'predecessor', 'successor'):
+            try:
+                expected = getattr(reference, name)(probe)
+            except KeyError:
+                assert_raises(KeyError, getattr(tree, name), probe)
+            else:
+                assert getattr(tree, name)(probe) == expected
+
+    for lo, hi, inclusive in [(10, 50, (True, False)), (9, 51, (False, True)),
+                              (None, 20, (True, True)), (90, None, (True, True))]:
+        for reverse in (False, True):
+            assert (list(tree.irange(lo, hi, inclusive, reverse)) ==
+                    list(reference.irange(lo, hi, inclusive, reverse)))
+
+    empty = PersistentAVLTree()
+    assert list(empty) == [] and len(empty) == 0
+    assert_raises(KeyError, empty.min)
@@ -0,0 +1,104 @@
+import random
+
+from nose.tools import assert_raises
+from avl import PooledAVLTree
+
+
+def check_tree(tree):
+    # Verify ordering, balance, parent links, heights and sizes
+    def check(node):
+        if node is None:
+            return 0, 0
+        lh, ls = check(node.left)
+        rh, rs = check(node.right)
+        assert node.is_balanced()
+        assert node.height == max(lh, rh) + 1
+        assert node.size == ls + rs + 1
+        for child in node.children:
+            if child is not None:
+                assert child.parent == node
+        return node.height, node.size
+
+    if tree.root is not None:
+        assert tree.root.parent is None
+    check(tree.root)
+    keys = list(tree.keys())
+    assert keys == sorted(keys)
+
+
+def test_from_sorted():
+    for n in range(20):
+        tree = PooledAVLTree.from_sorted(range(n))
+        check_tree(tree)
+        assert list(tree.keys()) == list(range(n))
+        assert len(tree) == n
+
+    tree = PooledAVLTree.from_keys([5, 1, 4, 2, 3])
+    assert list(tree) == [1, 2, 3, 4, 5]
+    assert_raises(ValueError, PooledAVLTree.from_sorted, [1, 1])
+    assert_raises(ValueError, PooledAVLTree.from_keys, [3, 1, 3])
+
+
+def test_insert_delete():
+    rng = random.Random(5)
+    tree = PooledAVLTree()
+    expected = set()
+
+    for _ in range(2000):
+        key = rng.randrange(500)
+        if key in expected:
+            assert_raises(ValueError, tree.insert, key)
+            tree.delete(key)
+            expected.remove(key)
+        else:
+            tree.insert(key)
+            expected.add(key)
+        assert len(tree) == len(expected)
+
+    check_tree(tree)
+    assert list(tree.keys()) == sorted(expected)
+    assert [x.key for x in tree.traverse(reverse=True)] == \
+        sorted(expected, reverse=True)
+
+    # Freed node ids are reused instead of growing the columns
+    columns = len(tree._key)
+    for key in sorted(expected):
+        tree.delete(key)
+    for key in sorted(expected):
+        tree.insert(key)
+    assert len(tree._key) == columns
+    check_tree(tree)
+
+    assert_raises(KeyError, tree.delete, -1)
+    assert_raises(KeyError, PooledAVLTree().delete, 1)
+
+
+def test_queries():
+    keys = list(range(0, 100, 5))
+    tree = PooledAVLTree.from_keys(keys)
+
+    assert 10 in tree and 11 not in tree
+    assert tree.find_node(15).key == 15
+    assert_raises(KeyError, tree.find_node, 16)
+    assert tree.min() == 0 and tree.max() == 95
+    assert tree.min_node().key == 0 and tree.max_node().key == 95
+    assert_raises(KeyError, PooledAVLTree().min)
+
+    assert [tree[i] for i in range(len(keys))] == keys
+    assert tree[-1] == 95
+    assert_raises(IndexError, tree.select, 20)
+    assert tree.rank(15) == 3 and tree.rank(16) == 4
+
+    assert list(tree.irange(10, 30)) == [10, 15, 20, 25]
+    assert list(tree.irange(10, 30, (False, True), True)) == [30, 25, 20, 15]
+    assert tree.floor(12) == 10 and tree.ceiling(12) == 15
+    assert tree.predecessor(10) == 5 and tree.successor(10) == 15
+    assert_raises(KeyError, tree.floor, -1)
+
+
+def test_setops():
+    t1 = PooledAVLTree.from_keys([1, 3, 5, 7, 9])
+    t2 = PooledAVLTree.from_keys([3, 6, 7])
+    assert list(t1.union(t2)) == [1, 3, 5, 6, 7, 9]
+    assert list(t1.intersection(t2)) == [3, 7]
+    check_tree(t1.union(t2))
@@ -0,0 +1,134 @@
+import random
+
+from nose.tools import assert_raises
+from avl import AVLTree, ShardedAVLTree
+from avl import sharded
+
+from testavl import check_same
+
+
+def check_shards(shards, tree):
+    probes = list(range(-3, 303, 7))
+    check_same(shards, tree, probes)
+    assert sum(shards.shard_sizes()) == len(tree)
+    assert shards.contains_many(probes) == [k in tree for k in probes]
+
+
+def test_sharded():
+    rng = random.Random(20)
+    keys = rng.sample(range(300), 120)
+    with ShardedAVLTree.from_keys(keys, shards=3) as shards:
+        tree = AVLTree.from_keys(keys)
+        check_shards(shards, tree)
+
+        for _ in range(200):
+            key = rng.randrange(300)
+            if key in tree:
+                shards.delete(key)
+                tree.delete(key)
+            else:
+                shards.insert(key)
+                tree.insert(key)
+        check_shards(shards, tree)
+
+        assert_raises(ValueError, shards.insert, tree.min())
+        assert_raises(KeyError, shards.delete, -1)
+        assert_raises(ValueError, shards.insert_many, [tree.min(), 1000])
+        assert_raises(KeyError, shards.delete_many, [tree.min(), -1])
+        check_shards(shards, tree)
+
+        shards.insert_many(range(0, 300, 4), ignore_duplicates=True)
+        tree.insert_many(range(0, 300, 4), ignore_duplicates=True)
+        shards.delete_many(range(0, 300, 3), ignore_missing=True)
+        tree.delete_many(range(0, 300, 3), ignore_missing=True)
+        check_shards(shards, tree)
+
+
+def test_set_algebra():
+    rng = random.Random(20)
+    a, b = rng.sample(range(300), 150), rng.sample(range(300), 100)
+    x, y = AVLTree.from_keys(a), AVLTree.from_keys(b)
+    with ShardedAVLTree.from_keys(a, shards=3) as shards, \
+            ShardedAVLTree.from_keys(b, shards=2) as other:
+        for operand in (y, other):
+            for name in ('union', 'intersection', 'difference',
+                         'symmetric_difference'):
+                with getattr(shards, name)(operand) as result:
+                    check_shards(result, getattr(x, name)(y))
+            for name in ('issubset', 'issuperset', 'isdisjoint'):
+                assert getattr(shards, name)(operand) == getattr(x, name)(y)
+
+        with shards & other as common:
+            assert common.issubset(shards) and common.issubset(y)
+            assert shards.issuperset(common) and not common.issuperset(x)
+            assert common.isdisjoint(shards - other)
+        assert_raises(TypeError, shards.union, AVLTree(key=abs))
+        assert_raises(TypeError, shards.__ior__, AVLTree(key=abs))
+
+        shards |= other
+        x |= y
+        check_shards(shards, x)
+        shards -= AVLTree.from_keys(range(0, 300, 5))
+        x -= AVLTree.from_keys(range(0, 300, 5))
+        check_shards(shards, x)
+        shards ^= other
+        x ^= y
+        check_shards(shards, x)
+        shards &= y
+        x &= y
+        check_shards(shards, x)
+
+
+def test_streaming():
+    saved = sharded.STREAM_CHUNK
+    sharded.STREAM_CHUNK = 7
+    try:
+        with ShardedAVLTree.from_keys(range(0, 300, 2), shards=3) as shards:
+            tree = AVLTree.from_keys(range(0, 300, 2))
+            check_shards(shards, tree)
+
+            # Chunks resume after the last key read, so changes further
+            # on, and rebalancing, are seen
+            keys = shards.keys()
+            assert [next(keys) for _ in range(10)] == list(range(0, 20, 2))
+            shards.insert(101)
+            shards.delete(100)
+            shards.rebalance()
+            assert list(keys) == sorted(set(range(20, 300, 2)) - {100} | {101})
+            assert list(shards.irange(150, reverse=True))[:3] == [298, 296, 294]
+    finally:
+        sharded.STREAM_CHUNK = saved
+
+    class Local(int):
+        'Instances of a local class can\'t be pickled'
+
+    with ShardedAVLTree.from_keys(range(300), shards=3) as shards:
+        assert_raises(Exception, shards.contains_many, [5, Local(250)])
+        # The reply from the shard already asked was read, not left queued
+        assert shards.min() == 0 and shards.max() == 299
+        assert 250 in shards
+
+
+def test_rebalance():
+    saved = sharded.MIN_SHARD_SIZE
+    sharded.MIN_SHARD_SIZE = 10
+    try:
+        with ShardedAVLTree(shards=4) as shards:
+            # Every key lands in the first shard until it grows skewed
+            for key in range(100):
+                shards.insert(key)
+            sizes = shards.shard_sizes()
+            assert max(sizes) <= 2 * max(sum(sizes) / 4, 10)
+            assert sum(1 for size in sizes if size) > 1
+
+            shards.delete_many(range(50))
+            assert list(shards.keys()) == list(range(50, 100))
+            assert max(shards.shard_sizes()) <= 2 * max(50 / 4, 10)
+    finally:
+        sharded.MIN_SHARD_SIZE = saved
+
+    with ShardedAVLTree(shards=2) as shards:
+        assert len(shards) == 0
+        assert list(shards.keys()) == []
+        assert_raises(KeyError, shards.min)
+        assert_raises(IndexError, shards.select, 0)
@@ -0,0 +1,143 @@
+import random
+import sys
+import threading
+from itertools import islice
+
+from nose.tools import assert_raises
+from avl import ConcurrentAVLTree
+from avl.threadsafe import RWLock
+
+from testavl import check_tree
+
+
+def stress(tree, writers=4, readers=4, rounds=1000):
+    '''
+    Run writer threads inserting and deleting their own keys against
+    reader threads querying and iterating, and return any errors seen
+    along with the keys each writer left behind
+    '''
+    # Multiples of 10 stay in the tree throughout; writer w owns the keys
+    # ending in w + 1
+    errors = []
+    remaining = [set() for _ in range(writers)]
+    done = threading.Event()
+
+    def write(w):
+        rng = random.Random(w)
+        mine = remaining[w]
+        try:
+            for _ in range(rounds):
+                key = rng.randrange(100) * 10 + w + 1
+                if key in mine:
+                    tree.delete(key)
+                    mine.remove(key)
+                else:
+                    tree.insert(key)
+                    mine.add(key)
+                if rng.random() < 0.05:
+                    batch = [rng.randrange(100) * 10 + w + 1 for _ in range(20)]
+                    tree.insert_many(batch, ignore_duplicates=True)
+                    mine.update(batch)
+        except Exception as e:
+            errors.append(e)
+
+    def read(r):
+        rng = random.Random(100 + r)
+        try:
+            while not done.is_set():
+                key = rng.randrange(100) * 10
+                assert key in tree
+                assert tree.find_node(key).key == key
+                assert tree.floor(key + 0.5) >= key
+                try:
+                    keys = list(tree.irange(key, key + 200))
+                except RuntimeError:
+                    continue
+                assert keys == sorted(set(keys))
+                assert set(range(key, key + 200, 10)) <= set(keys)
+        except Exception as e:
+            errors.append(e)
+
+    threads = ([threading.Thread(target=write, args=(w,))
+                for w in range(writers)] +
+               [threading.Thread(target=read, args=(r,))
+                for r in range(readers)])
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-5)
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads[:writers]:
+            thread.join()
+        done.set()
+        for thread in threads[writers:]:
+            thread.join()
+    finally:
+        sys.setswitchinterval(interval)
+    return errors, remaining
+
+
+def test_stress():
+    tree = ConcurrentAVLTree.from_keys(range(0, 1200, 10))
+    errors, remaining = stress(tree)
+    assert not errors, errors
+
+    check_tree(tree.tree)
+    expected = set(range(0, 1200, 10)).union(*remaining)
+    assert list(tree.keys()) == sorted(expected)
+    assert len(tree) == len(expected)
+
+
+def test_iteration():
+    tree = ConcurrentAVLTree.from_keys(range(2000))
+    keys = tree.keys()
+    assert next(keys) == 0
+    # Failed writes change nothing, so the iterator carries on
+    assert_raises(ValueError, tree.insert, 0)
+    assert_raises(KeyError, tree.delete, -1)
+    assert list(islice(keys, 300)) == list(range(1, 301))
+    tree.insert(5000)
+    assert_raises(RuntimeError, list, keys)
+
+    snapshot = tree.snapshot()
+    keys = snapshot.keys()
+    next(keys)
+    tree.delete(5000)
+    assert list(keys) == list(range(1, 2000)) + [5000]
+    assert list(tree.keys()) == list(range(2000))
+
+    # An iterator whose first step waits on a write starts after it
+    keys = tree.keys()
+    first = []
+    reader = threading.Thread(target=lambda: first.append(next(keys)))
+    with tree.lock.write():
+        reader.start()
+        reader.join(0.1)
+        tree.tree.insert(-1)
+        tree.version += 1
+    reader.join()
+    assert first == [-1]
+
+
+def test_rwlock():
+    lock = RWLock()
+    inside = []
+    readers_in = threading.Barrier(3)
+
+    def read():
+        with lock.read():
+            inside.append('r')
+            # All three readers hold the lock together
+            readers_in.wait(timeout=5)
+
+    threads = [threading.Thread(target=read) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert inside == ['r'] * 3
+
+    with lock.write():
+        pass
+    with lock.read():
+        pass
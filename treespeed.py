@@ -1,8 +1,387 @@
-import random, sys
+'''
+Benchmarks for avl.AVLTree, with and without its hash index, against a
+sorted list maintained with bisect and a built-in set.
+
+Every combination of structure, operation, size and key distribution is
+timed, then rerun under tracemalloc for peak memory and with counting
+keys for the number of comparisons, which stands in for node visits.
+Results are written as JSON so runs from different commits can be
+compared:
+
+    python treespeed.py --sizes 1000 100000 --output new.json
+    python treespeed.py --compare old.json new.json
+'''
+import argparse
+import bisect
+import heapq
+import json
+import platform
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+
 from avl import AVLTree
 
-rvals = list({random.randint(0, sys.maxsize) for x in range(5000)})
-tree = AVLTree()
+OPERATIONS = ['insert', 'delete', 'contains', 'local_contains', 'traversal',
+              'minmax', 'union', 'intersection']
+DISTRIBUTIONS = ['sorted', 'reverse', 'random', 'clustered']
+MINMAX_CALLS = 1000
+
+
+# Key distributions. Each returns n distinct ints in the order they are
+# fed to the structure.
+
+def make_keys(distribution, n, rng):
+    if distribution == 'sorted':
+        return list(range(0, 2 * n, 2))
+    elif distribution == 'reverse':
+        return list(range(2 * n - 2, -1, -2))
+    elif distribution == 'random':
+        return rng.sample(range(10 * n), n)
+    elif distribution == 'clustered':
+        # Runs of 100 consecutive keys at scattered offsets
+        runs = (n + 99) // 100
+        starts = rng.sample(range(runs * 10), runs)
+        keys = [start * 1000 + i for start in starts for i in range(100)]
+        return keys[:n]
+    raise ValueError('Unknown distribution: {}'.format(distribution))
+
+
+class CountedKey(object):
+
+    'An int wrapper that counts every comparison made against it'
+    __slots__ = ['value']
+    comparisons = 0
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        CountedKey.comparisons += 1
+        return self.value < other.value
+
+    def __gt__(self, other):
+        CountedKey.comparisons += 1
+        return self.value > other.value
+
+    def __le__(self, other):
+        CountedKey.comparisons += 1
+        return self.value <= other.value
+
+    def __ge__(self, other):
+        CountedKey.comparisons += 1
+        return self.value >= other.value
+
+    def __eq__(self, other):
+        CountedKey.comparisons += 1
+        return self.value == other.value
+
+    def __hash__(self):
+        return hash(self.value)
+
+
+# Structures under test, behind a common interface
+
+class AVLStructure(object):
+    name = 'avl'
+
+    def __init__(self, keys=()):
+        self.tree = AVLTree.from_keys(keys)
+
+    def insert(self, key):
+        self.tree.insert(key)
+
+    def delete(self, key):
+        self.tree.delete(key)
+
+    def contains(self, key):
+        return key in self.tree
+
+    def traverse(self):
+        return self.tree.keys()
+
+    def minmax(self):
+        return self.tree.min(), self.tree.max()
+
+    def union(self, other):
+        return self.tree.union(other.tree)
+
+    def intersection(self, other):
+        return self.tree.intersection(other.tree)
+
+
+class HashIndexedAVLStructure(AVLStructure):
+
+    'AVLTree with a hash index, trading memory for O(1) point lookups'
+    name = 'avl-hash'
+
+    def __init__(self, keys=()):
+        self.tree = AVLTree.from_keys(keys, hash_index=True)
+
+
+class BisectStructure(object):
+    name = 'bisect'
+
+    def __init__(self, keys=()):
+        self.keys = sorted(keys)
+
+    def insert(self, key):
+        bisect.insort(self.keys, key)
+
+    def delete(self, key):
+        i = bisect.bisect_left(self.keys, key)
+        if i == len(self.keys) or self.keys[i] != key:
+            raise KeyError(key)
+        del self.keys[i]
+
+    def contains(self, key):
+        i = bisect.bisect_left(self.keys, key)
+        return i < len(self.keys) and self.keys[i] == key
+
+    def traverse(self):
+        return iter(self.keys)
+
+    def minmax(self):
+        return self.keys[0], self.keys[-1]
+
+    def union(self, other):
+        merged = []
+        for key in heapq.merge(self.keys, other.keys):
+            if not merged or merged[-1] != key:
+                merged.append(key)
+        return merged
+
+    def intersection(self, other):
+        present = set(other.keys)
+        return [key for key in self.keys if key in present]
+
+
+class SetStructure(object):
+    name = 'set'
+
+    def __init__(self, keys=()):
+        self.keys = set(keys)
+
+    def insert(self, key):
+        self.keys.add(key)
+
+    def delete(self, key):
+        self.keys.remove(key)
+
+    def contains(self, key):
+        return key in self.keys
+
+    def traverse(self):
+        return iter(sorted(self.keys))
+
+    def minmax(self):
+        return min(self.keys), max(self.keys)
+
+    def union(self, other):
+        return self.keys | other.keys
+
+    def intersection(self, other):
+        return self.keys & other.keys
+
+
+class FingerAVLStructure(AVLStructure):
+
+    'AVLTree searching from the last node touched, for local access'
+    name = 'avl-finger'
+
+    def __init__(self, keys=()):
+        self.tree = AVLTree.from_keys(keys, finger=True)
+
+
+STRUCTURES = {cls.name: cls for cls in
+              (AVLStructure, HashIndexedAVLStructure, FingerAVLStructure,
+               BisectStructure, SetStructure)}
+
+
+# Operations. Each takes a structure class and int keys, does its setup,
+# and returns a function to measure along with the number of operations
+# that function performs. wrap converts every key the structure sees.
+
+def setup(op, cls, keys, rng, wrap=None):
+    def wrapped(seq):
+        return list(seq) if wrap is None else [wrap(key) for key in seq]
+
+    if op == 'insert':
+        keys = wrapped(keys)
+        def run():
+            s = cls()
+            for key in keys:
+                s.insert(key)
+        return run, len(keys)
+
+    elif op == 'delete':
+        keys = wrapped(keys)
+        s = cls(keys)
+        def run():
+            for key in keys:
+                s.delete(key)
+        return run, len(keys)
+
+    elif op in ('contains', 'local_contains'):
+        # Half of the probes hit and half miss. Local probes come in key
+        # order, so each lands next to the one before.
+        if op == 'contains':
+            probes = keys[::2] + [-1 - key for key in keys[1::2]]
+            rng.shuffle(probes)
+        else:
+            probes = sorted(keys[::2] + [key + 1 for key in keys[1::2]])
+        s = cls(wrapped(keys))
+        probes = wrapped(probes)
+        def run():
+            for key in probes:
+                s.contains(key)
+        return run, len(probes)
+
+    elif op == 'traversal':
+        s = cls(wrapped(keys))
+        def run():
+            for key in s.traverse():
+                pass
+        return run, len(keys)
+
+    elif op == 'minmax':
+        s = cls(wrapped(keys))
+        def run():
+            for _ in range(MINMAX_CALLS):
+                s.minmax()
+        return run, MINMAX_CALLS
+
+    elif op in ('union', 'intersection'):
+        # Two operands sharing about half their keys
+        half = len(keys) // 2
+        a = cls(wrapped(keys))
+        b = cls(wrapped(keys[half:] + [-1 - key for key in keys[:half]]))
+        method = getattr(cls, op)
+        def run():
+            method(a, b)
+        return run, 2 * len(keys)
+
+    raise ValueError('Unknown operation: {}'.format(op))
+
+
+def measure(op, cls, keys, seed, metrics):
+    result = {}
+
+    if 'time' in metrics:
+        run, count = setup(op, cls, keys, random.Random(seed))
+        start = time.perf_counter()
+        run()
+        elapsed = time.perf_counter() - start
+        result['ops'] = count
+        result['seconds'] = elapsed
+        result['ops_per_sec'] = count / elapsed if elapsed else None
+
+    if 'memory' in metrics:
+        run, count = setup(op, cls, keys, random.Random(seed))
+        tracemalloc.start()
+        run()
+        result['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    if 'comparisons' in metrics:
+        run, count = setup(op, cls, keys, random.Random(seed), CountedKey)
+        CountedKey.comparisons = 0
+        run()
+        result['comparisons_per_op'] = CountedKey.comparisons / count
+
+    return result
+
+
+def git_revision():
+    try:
+        out = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                             capture_output=True, text=True, check=True)
+        return out.stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_suite(args):
+    results = []
+    for size in args.sizes:
+        for distribution in args.distributions:
+            keys = make_keys(distribution, size, random.Random(args.seed))
+            for op in args.ops:
+                for name in args.structures:
+                    row = {'structure': name, 'op': op, 'size': size,
+                           'distribution': distribution}
+                    row.update(measure(op, STRUCTURES[name], keys,
+                                       args.seed, args.metrics))
+                    results.append(row)
+                    print(format_row(row), file=sys.stderr)
+
+    return {'meta': {'revision': git_revision(),
+                     'python': platform.python_version(),
+                     'platform': platform.platform(),
+                     'seed': args.seed,
+                     'time': time.strftime('%Y-%m-%dT%H:%M:%S')},
+            'results': results}
+
+
+def format_row(row):
+    def fmt(value, spec):
+        return format(value, spec) if value is not None else '-'.rjust(12)
+
+    return '{:8} {:12} {:>9} {:10} {} ops/s {} bytes {} cmp/op'.format(
+        row['structure'], row['op'], row['size'], row['distribution'],
+        fmt(row.get('ops_per_sec'), '12.0f'),
+        fmt(row.get('peak_bytes'), '12d'),
+        fmt(row.get('comparisons_per_op'), '8.2f'))
+
+
+def compare(old_path, new_path):
+    'Print the ratio of new to old throughput for each shared benchmark'
+    def load(path):
+        with open(path) as f:
+            rows = json.load(f)['results']
+        return {(r['structure'], r['op'], r['size'], r['distribution']): r
+                for r in rows}
+
+    old, new = load(old_path), load(new_path)
+    for key in sorted(set(old) & set(new)):
+        a = old[key].get('ops_per_sec')
+        b = new[key].get('ops_per_sec')
+        if a and b:
+            print('{:8} {:12} {:>9} {:10} {:6.2f}x'.format(*key, b / a))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[1000, 10000, 100000])
+    parser.add_argument('--ops', nargs='+', choices=OPERATIONS,
+                        default=OPERATIONS)
+    parser.add_argument('--distributions', nargs='+', choices=DISTRIBUTIONS,
+                        default=DISTRIBUTIONS)
+    parser.add_argument('--structures', nargs='+', choices=sorted(STRUCTURES),
+                        default=sorted(STRUCTURES))
+    parser.add_argument('--metrics', nargs='+',
+                        choices=['time', 'memory', 'comparisons'],
+                        default=['time', 'memory', 'comparisons'])
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write JSON results to this file')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help='compare two JSON result files and exit')
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    report = run_suite(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=1, sort_keys=True)
+
 
-for val in rvals:
-	tree.insert(val)
+if __name__ == '__main__':
+    main()